@@ -0,0 +1,37 @@
+import asyncio
+import dataclasses
+import logging
+from typing import Optional
+
+
+@dataclasses.dataclass
+class ActiveRun:
+    msg_id: int
+    author_id: int
+    task: asyncio.Task
+    # Why the run was stopped, shown on the response. None while it runs
+    stop_reason: Optional[str] = None
+
+
+class RunRegistry:
+    """Responses in progress by the ID of the message that triggered them, so they can be stopped when it is edited or deleted"""
+
+    def __init__(self):
+        self.runs: dict[int, ActiveRun] = {}
+
+    def start(self, msg_id: int, author_id: int) -> ActiveRun:
+        run = self.runs[msg_id] = ActiveRun(msg_id, author_id, asyncio.current_task())
+        return run
+
+    def finish(self, run: ActiveRun):
+        if self.runs.get(run.msg_id) is run:
+            del self.runs[run.msg_id]
+
+    def stop(self, msg_id: int, reason: str) -> Optional[ActiveRun]:
+        """Cancel the run triggered by a message. Returns the run if it was stopped"""
+        if (run := self.runs.get(msg_id)) is None or run.stop_reason is not None or run.task.done():
+            return None
+        run.stop_reason = reason
+        run.task.cancel()
+        logging.info(f"Stopped response to message {msg_id} ({reason})")
+        return run
@@ -0,0 +1,189 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import time
+from typing import AsyncIterator, Optional
+
+DEFAULT_MAX_QUEUE = 50
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Ticket:
+    user_id: int
+    channel_id: int
+    provider: str
+    future: asyncio.Future
+    enqueued_at: float = dataclasses.field(default_factory=time.monotonic)
+
+
+class AdmissionScheduler:
+    """
+    Admission control in front of model runs, with global, per-provider, per-user and per-channel concurrency caps.
+    Waiting requests are queued per user and granted round robin across users so one user can't starve the others.
+    Requests beyond `max_queue` waiting ones are rejected
+    """
+
+    def __init__(self):
+        self.max_concurrent: Optional[int] = None
+        self.per_user: Optional[int] = None
+        self.per_channel: Optional[int] = None
+        self.per_provider: dict[str, int] = {}
+        self.max_queue = DEFAULT_MAX_QUEUE
+        self.version: Optional[int] = None
+
+        self.active = 0
+        self._active_by: dict[str, collections.Counter] = {key: collections.Counter() for key in ("user", "channel", "provider")}
+        # User ID -> their waiting tickets, in round robin order
+        self._queues: collections.OrderedDict[int, collections.deque[Ticket]] = collections.OrderedDict()
+        self.queued = 0
+        # Attempts waiting for a provider slot, woken whenever a slot is freed
+        self._provider_waiters: list[asyncio.Future] = []
+
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def configure(self, options: Optional[dict], providers: dict, version: Optional[int] = None):
+        """Apply the `admission` config and providers' `max_concurrency`. Unset caps are unlimited"""
+        if version is not None and version == self.version:
+            return
+        options = options or {}
+        self.max_concurrent = options.get("max_concurrent")
+        self.per_user = options.get("per_user")
+        self.per_channel = options.get("per_channel")
+        self.per_provider = {name: provider["max_concurrency"] for name, provider in providers.items() if (provider or {}).get("max_concurrency")}
+        self.max_queue = options.get("max_queue", DEFAULT_MAX_QUEUE)
+        self.version = version
+        self._dispatch()
+
+    def _can_run(self, ticket: Ticket) -> bool:
+        return (
+            (self.max_concurrent is None or self.active < self.max_concurrent)
+            and (self.per_user is None or self._active_by["user"][ticket.user_id] < self.per_user)
+            and (self.per_channel is None or self._active_by["channel"][ticket.channel_id] < self.per_channel)
+            and (ticket.provider not in self.per_provider or self._active_by["provider"][ticket.provider] < self.per_provider[ticket.provider])
+        )
+
+    @staticmethod
+    def _keys(ticket: Ticket):
+        return (("user", ticket.user_id), ("channel", ticket.channel_id), ("provider", ticket.provider))
+
+    def _start(self, ticket: Ticket):
+        self.active += 1
+        for kind, key in self._keys(ticket):
+            self._active_by[kind][key] += 1
+
+        wait = time.monotonic() - ticket.enqueued_at
+        self.admitted += 1
+        self.wait_seconds_total += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+
+    def _dispatch(self):
+        # Each pass offers a slot to the oldest ticket of every waiting user, users that got one go to the back
+        granted = True
+        while granted and self._queues:
+            granted = False
+            for user_id in list(self._queues):
+                queue = self._queues[user_id]
+                # Cancelled waiters are removed once their task resumes, until then skip them
+                while queue and queue[0].future.done():
+                    queue.popleft()
+                    self.queued -= 1
+                if not queue:
+                    del self._queues[user_id]
+                    continue
+                if not self._can_run(queue[0]):
+                    continue
+
+                ticket = queue.popleft()
+                self.queued -= 1
+                self._start(ticket)
+                ticket.future.set_result(None)
+                granted = True
+
+                del self._queues[user_id]
+                if queue:
+                    self._queues[user_id] = queue
+
+    async def acquire(self, user_id: int, channel_id: int, provider: str) -> Ticket:
+        """Wait for a slot. Raises AdmissionRejected if the queue is full"""
+        ticket = Ticket(user_id, channel_id, provider, asyncio.get_running_loop().create_future())
+        if not self._queues and self._can_run(ticket):
+            self._start(ticket)
+            return ticket
+
+        if self.queued >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"{self.queued} requests are already waiting")
+
+        self._queues.setdefault(user_id, collections.deque()).append(ticket)
+        self.queued += 1
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(ticket)
+            elif (queue := self._queues.get(user_id)) is not None and ticket in queue:
+                # Not dispatched yet
+                queue.remove(ticket)
+                self.queued -= 1
+                if not queue:
+                    del self._queues[user_id]
+            raise
+        return ticket
+
+    def _provider_full(self, provider: str) -> bool:
+        return provider in self.per_provider and self._active_by["provider"][provider] >= self.per_provider[provider]
+
+    def _freed(self, kind: str, key) -> None:
+        self._active_by[kind][key] -= 1
+        if not self._active_by[kind][key]:
+            del self._active_by[kind][key]
+
+    def _wake_provider_waiters(self):
+        waiters, self._provider_waiters = self._provider_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def provider_slot(self, provider: str) -> AsyncIterator[None]:
+        """
+        Hold a slot of `provider` for a failover or hedge attempt, which an admitted request makes besides the one
+        its ticket was charged for. Waits while the provider is at its max_concurrency
+        """
+        while self._provider_full(provider):
+            waiter = asyncio.get_running_loop().create_future()
+            self._provider_waiters.append(waiter)
+            await waiter
+
+        self._active_by["provider"][provider] += 1
+        try:
+            yield
+        finally:
+            self._freed("provider", provider)
+            self._dispatch()
+            self._wake_provider_waiters()
+
+    def release(self, ticket: Ticket):
+        self.active -= 1
+        for kind, key in self._keys(ticket):
+            self._freed(kind, key)
+        self._dispatch()
+        self._wake_provider_waiters()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "wait_seconds_total": self.wait_seconds_total,
+            "wait_seconds_max": self.wait_seconds_max,
+        }
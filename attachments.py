@@ -0,0 +1,245 @@
+import asyncio
+import collections
+import concurrent.futures
+import dataclasses
+import importlib.util
+import io
+import logging
+import os
+import tempfile
+from typing import Any, Callable, Coroutine, Optional
+
+import discord
+import httpx
+from pydantic_ai.messages import BinaryContent, ImageUrl, ModelMessage, ModelRequest, UserPromptPart
+
+from metrics import ATTACHMENT_DOWNLOAD_SECONDS
+
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "llmcord-attachments")
+DEFAULT_CACHE_MAX_MB = 512
+DEFAULT_MAX_FILE_MB = 20
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Pillow is only imported once an image is preprocessed, images are sent as is when it isn't installed
+PREPROCESSING_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+
+class AttachmentTooLarge(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class ImageOptions:
+    """How images are downscaled and re-encoded before being sent to a model, from `image_preprocess` under `models:`"""
+    max_size: int = 1568
+    format: str = "webp"
+    quality: int = 85
+
+    @classmethod
+    def from_config(cls, options: Optional[dict]) -> Optional["ImageOptions"]:
+        if not options:
+            return None
+        options = dict(options)
+        if "format" in options:
+            options["format"] = {"jpg": "jpeg"}.get(options["format"].lower(), options["format"].lower())
+        return cls(**options)
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.format}"
+
+    def variant_key(self, key: str) -> str:
+        return f"{key}.{self.max_size}.{self.quality}.{self.format}"
+
+
+def preprocess_image(data: bytes, options: ImageOptions) -> bytes:
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as image:
+        image.thumbnail((options.max_size, options.max_size))
+        if options.format == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+
+        out = io.BytesIO()
+        image.save(out, format=options.format.upper(), quality=options.quality)
+        return out.getvalue()
+
+
+class AttachmentStore:
+    """
+    Content-addressed on-disk cache of downloaded attachments with LRU eviction.
+    MsgNodes keep handles (ImageUrl with an `attachment_key` in vendor_metadata) and the bytes are only
+    loaded for the duration of a run
+    """
+
+    def __init__(self, http_client: httpx.AsyncClient, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024, max_file_bytes: int = DEFAULT_MAX_FILE_MB * 1024 * 1024):
+        self.http_client = http_client
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+
+        self._entries: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self.total_bytes = 0
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="image-preprocess")
+
+        os.makedirs(self.path, exist_ok=True)
+        files = [entry for entry in os.scandir(self.path) if entry.is_file() and not entry.name.endswith(".tmp")]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_atime):
+            self._entries[entry.name] = entry.stat().st_size
+            self.total_bytes += entry.stat().st_size
+
+    @classmethod
+    def from_config(cls, http_client: httpx.AsyncClient, options: Optional[dict]) -> "AttachmentStore":
+        options = options or {}
+        return cls(
+            http_client,
+            path=options.get("path", DEFAULT_CACHE_PATH),
+            max_bytes=int(options.get("max_mb", DEFAULT_CACHE_MAX_MB) * 1024 * 1024),
+            max_file_bytes=int(options.get("max_file_mb", DEFAULT_MAX_FILE_MB) * 1024 * 1024),
+        )
+
+    @staticmethod
+    def key(att: discord.Attachment) -> str:
+        return f"{att.id}-{att.size}"
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+
+    async def _write(self, key: str, data: bytes | bytearray):
+        def write():
+            tmp_file = self._file(key) + ".tmp"
+            with open(tmp_file, "wb") as file:
+                file.write(data)
+            os.replace(tmp_file, self._file(key))
+
+        await asyncio.to_thread(write)
+        self._entries[key] = len(data)
+        self.total_bytes += len(data)
+        self._evict()
+
+    async def _download(self, key: str, url: str):
+        data = bytearray()
+        with ATTACHMENT_DOWNLOAD_SECONDS.time():
+            async with self.http_client.stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    data += chunk
+                    if len(data) > self.max_file_bytes:
+                        raise AttachmentTooLarge(f"Attachment {key} is larger than {self.max_file_bytes} bytes")
+
+        await self._write(key, data)
+
+    async def _preprocess(self, key: str, url: str, options: ImageOptions):
+        await self.fetch(key, url)
+        data = await asyncio.to_thread(self._read, key)
+        processed = await asyncio.get_running_loop().run_in_executor(self._executor, preprocess_image, data, options)
+        await self._write(options.variant_key(key), processed)
+
+    async def _ensure(self, key: str, create: Callable[[], Coroutine[Any, Any, None]]):
+        """Make sure `key` is stored, creating it at most once concurrently"""
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+
+        if (task := self._tasks.get(key)) is None:
+            task = self._tasks[key] = asyncio.create_task(create())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        await asyncio.shield(task)
+
+    async def fetch(self, key: str, url: str):
+        await self._ensure(key, lambda: self._download(key, url))
+
+    async def handle(self, att: discord.Attachment) -> Optional[ImageUrl]:
+        """Download an attachment into the store and return a handle to it, or None if it is too large or can't be downloaded"""
+        if att.size > self.max_file_bytes:
+            return None
+
+        key = self.key(att)
+        try:
+            await self.fetch(key, att.url)
+        except AttachmentTooLarge:
+            return None
+        except httpx.HTTPError:
+            logging.exception(f"Error downloading attachment {key}")
+            return None
+
+        return ImageUrl(att.url, vendor_metadata={"attachment_key": key, "media_type": att.content_type})
+
+    async def load(self, handle: ImageUrl, image_options: Optional[ImageOptions] = None) -> Optional[BinaryContent]:
+        """Load a handle's content, preprocessed once per attachment and options rather than once per turn"""
+        original_key = handle.vendor_metadata["attachment_key"]
+        for attempt in range(2):
+            key, media_type = original_key, handle.vendor_metadata["media_type"]
+            try:
+                if image_options is not None and PREPROCESSING_AVAILABLE:
+                    variant_key = image_options.variant_key(key)
+                    await self._ensure(variant_key, lambda: self._preprocess(key, handle.url, image_options))
+                    key, media_type = variant_key, image_options.media_type
+                else:
+                    # Evicted since the handle was created, Discord CDN URLs stay valid for a while
+                    await self.fetch(key, handle.url)
+                data = await asyncio.to_thread(self._read, key)
+            except FileNotFoundError:
+                if attempt:
+                    logging.exception(f"Error loading attachment {key}")
+                    return None
+                # Removed after it was found in the index, e.g. evicted meanwhile or by a temp directory cleaner
+                self._forget_missing(original_key, image_options.variant_key(original_key) if image_options is not None else None)
+                continue
+            except (httpx.HTTPError, AttachmentTooLarge):
+                logging.exception(f"Error loading attachment {key}")
+                return None
+            except Exception as e:
+                # Not an image Pillow can read, send it as is
+                logging.warning(f"Couldn't preprocess attachment {key}, sending it as is: {e!r}")
+                return await self.load(handle)
+
+            return BinaryContent(data=data, media_type=media_type)
+
+    def _forget_missing(self, *keys: Optional[str]):
+        for key in keys:
+            if key in self._entries and not os.path.exists(self._file(key)):
+                self.total_bytes -= self._entries.pop(key)
+
+    def _read(self, key: str) -> bytes:
+        with open(self._file(key), "rb") as file:
+            return file.read()
+
+    async def materialize(self, messages: list[ModelMessage], image_options: Optional[ImageOptions] = None) -> list[ModelMessage]:
+        """Replace attachment handles with their content for a run. Messages without handles are returned as is"""
+        async def materialize_part(part):
+            if not isinstance(part, UserPromptPart) or isinstance(part.content, str) or not any(is_handle(item) for item in part.content):
+                return part
+
+            content = []
+            for item in part.content:
+                if not is_handle(item):
+                    content.append(item)
+                elif (loaded := await self.load(item, image_options)) is not None:
+                    content.append(loaded)
+            return dataclasses.replace(part, content=content)
+
+        async def materialize_message(message):
+            if not isinstance(message, ModelRequest):
+                return message
+            parts = [await materialize_part(part) for part in message.parts]
+            if all(new is old for new, old in zip(parts, message.parts)):
+                return message
+            return dataclasses.replace(message, parts=parts)
+
+        return list(await asyncio.gather(*(materialize_message(message) for message in messages)))
+
+
+def is_handle(item) -> bool:
+    return isinstance(item, ImageUrl) and bool(item.vendor_metadata) and "attachment_key" in item.vendor_metadata
@@ -0,0 +1,107 @@
+import array
+import importlib.util
+import threading
+from typing import Callable
+
+import discord
+
+FRAME_BYTES = discord.opus.Encoder.FRAME_SIZE  # 20ms of 48kHz 16 bit stereo
+FRAME_MS = discord.opus.Encoder.FRAME_LENGTH
+SILENCE = bytes(FRAME_BYTES)
+DEFAULT_PREFILL_MS = 60
+# Frames of silence after the buffer runs dry before playback is paused
+IDLE_FRAMES = 10
+
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+
+def upsample(samples: bytes, previous: int) -> tuple[bytes, int]:
+    """
+    24kHz mono to 48kHz stereo 16 bit PCM. New samples are interpolated halfway between neighbours,
+    `previous` is the last sample of the previous call so chunks join up
+    """
+    if NUMPY_AVAILABLE:
+        import numpy as np
+
+        current = np.frombuffer(samples, dtype=np.int16).astype(np.int32)
+        midpoints = (np.concatenate(([previous], current[:-1])) + current) >> 1
+        out = np.empty((len(current), 4), dtype=np.int16)
+        out[:, 0] = out[:, 1] = midpoints
+        out[:, 2] = out[:, 3] = current
+        return out.tobytes(), int(current[-1])
+
+    current = array.array("h", samples)
+    midpoints = array.array("h", [(a + b) >> 1 for a, b in zip([previous, *current[:-1]], current)])
+    out = array.array("h", bytes(len(current) * 8))
+    out[0::4] = out[1::4] = midpoints
+    out[2::4] = out[3::4] = current
+    return out.tobytes(), current[-1]
+
+
+class GeminiAudioSource(discord.AudioSource):
+    """
+    Plays Gemini's 24kHz mono PCM without an ffmpeg process. Audio is resampled when it arrives and played from a jitter buffer:
+    playback starts once `prefill_ms` is buffered, and `on_idle` is called from the audio thread when the buffer has been empty for a while.
+    The source is reused for every turn of a session
+    """
+
+    def __init__(self, on_idle: Callable[[], None], prefill_ms: int = DEFAULT_PREFILL_MS):
+        self.on_idle = on_idle
+        self.prefill_frames = -(-prefill_ms // FRAME_MS)
+
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._previous = 0
+        # Odd byte left over from a chunk, completed by the next one
+        self._remainder = b""
+        self._waiting = True
+        self._waited_frames = 0
+        self._idle_frames = 0
+
+    def feed(self, data: bytes):
+        data = self._remainder + data
+        if len(data) % 2:
+            data, self._remainder = data[:-1], data[-1:]
+        else:
+            self._remainder = b""
+        if not data:
+            return
+
+        pcm, self._previous = upsample(data, self._previous)
+        with self._lock:
+            self._buffer += pcm
+            self._idle_frames = 0
+
+    def flush(self):
+        """Drop everything that hasn't been played, e.g. when the user interrupts"""
+        with self._lock:
+            self._buffer.clear()
+            self._remainder = b""
+            self._previous = 0
+
+    def is_idle(self) -> bool:
+        with self._lock:
+            return not self._buffer
+
+    def read(self) -> bytes:
+        with self._lock:
+            if self._waiting:
+                # Give the buffer a chance to fill, but don't hold back a short reply forever
+                if len(self._buffer) < self.prefill_frames * FRAME_BYTES and self._waited_frames < self.prefill_frames:
+                    self._waited_frames += 1
+                    return SILENCE
+                self._waiting = False
+                self._waited_frames = 0
+
+            if self._buffer:
+                frame = bytes(self._buffer[:FRAME_BYTES]).ljust(FRAME_BYTES, b"\0")
+                del self._buffer[:FRAME_BYTES]
+                self._idle_frames = 0
+                return frame
+
+            self._idle_frames += 1
+            if self._idle_frames == IDLE_FRAMES:
+                self._waiting = True
+                self._idle_frames = 0
+                self.on_idle()
+            return SILENCE
@@ -0,0 +1,268 @@
+import array
+import asyncio
+import collections
+import importlib.util
+import logging
+import threading
+import time
+import weakref
+from typing import Awaitable, Callable, Hashable, Optional
+
+from metrics import registry
+
+SAMPLE_RATE = 16000
+BYTES_PER_MS = SAMPLE_RATE * 2 // 1000  # 16 bit mono
+DEFAULT_CHUNK_MS = 100
+DEFAULT_BUFFER_MS = 1000
+# A backlog is sent in one request of up to this many chunks instead of one request per chunk
+MAX_CHUNKS_PER_SEND = 4
+
+# Discord voice is decoded to 20ms frames of 48kHz 16 bit stereo, 6 values per 16kHz mono sample
+DISCORD_VALUES_PER_SAMPLE = 6
+FRAME_MS = 20
+DEFAULT_VAD_THRESHOLD = 300
+DEFAULT_VAD_HANGOVER_MS = 300
+# Frames kept per speaker while waiting to be mixed, older ones are dropped
+MAX_PENDING_FRAMES = 5
+
+NUMPY_AVAILABLE = importlib.util.find_spec("numpy") is not None
+
+UPLINK_SEND_SECONDS = registry.histogram("llmcord_voice_uplink_send_seconds", "Time to send one chunk of voice audio to Gemini")
+UPLINK_AUDIO_MS = registry.counter("llmcord_voice_uplink_audio_ms_total", "Voice audio by result (sent or dropped), in milliseconds")
+
+_uplinks: weakref.WeakSet["AudioUplink"] = weakref.WeakSet()
+registry.gauge(
+    "llmcord_voice_uplink_buffered_ms", "Voice audio waiting to be sent to Gemini, in milliseconds",
+    lambda: sum(uplink.buffered_ms() for uplink in _uplinks),
+)
+
+
+class AudioUplink:
+    """
+    Moves 16kHz PCM from the audio thread to Gemini. Writes go into a preallocated ring buffer,
+    a single task on the event loop sends it in `chunk_ms` chunks. When sending falls behind by more than
+    `buffer_ms` the oldest audio is dropped
+    """
+
+    def __init__(
+        self,
+        send: Callable[[bytes], Awaitable],
+        loop: asyncio.AbstractEventLoop,
+        chunk_ms: int = DEFAULT_CHUNK_MS,
+        buffer_ms: int = DEFAULT_BUFFER_MS,
+        send_end: Optional[Callable[[], Awaitable]] = None,
+    ):
+        self.send = send
+        self.send_end = send_end
+        self.loop = loop
+        self.chunk_bytes = chunk_ms * BYTES_PER_MS
+        self.capacity = max(buffer_ms, chunk_ms * MAX_CHUNKS_PER_SEND) * BYTES_PER_MS
+
+        self._buffer = bytearray(self.capacity)
+        self._head = 0
+        self._size = 0
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+        # Set while a wakeup is pending so the audio thread schedules at most one per chunk
+        self._notified = False
+        self._end_pending = False
+        self._task: Optional[asyncio.Task] = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+        _uplinks.add(self)
+
+    def buffered_ms(self) -> float:
+        return self._size / BYTES_PER_MS
+
+    def write(self, data: bytes):
+        """Called from the audio thread"""
+        with self._lock:
+            dropped = max(0, self._size + len(data) - self.capacity)
+            if dropped:
+                # Dropping whole samples keeps the stream aligned
+                dropped += dropped % 2
+                from_buffer = min(dropped, self._size)
+                self._head = (self._head + from_buffer) % self.capacity
+                self._size -= from_buffer
+                data = data[dropped - from_buffer:]
+
+            tail = (self._head + self._size) % self.capacity
+            first = min(len(data), self.capacity - tail)
+            self._buffer[tail:tail + first] = data[:first]
+            self._buffer[:len(data) - first] = data[first:]
+            self._size += len(data)
+
+            notify = self._size >= self.chunk_bytes and not self._notified
+            self._notified |= notify
+
+        if dropped:
+            UPLINK_AUDIO_MS.inc(dropped / BYTES_PER_MS, result="dropped")
+        if notify:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    def end_stream(self):
+        """Called from the audio thread when nobody is speaking, `send_end` runs once the buffered audio is sent"""
+        with self._lock:
+            self._end_pending = True
+            notify = not self._notified
+            self._notified = True
+        if notify:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    def _read(self, limit: int) -> bytes:
+        with self._lock:
+            size = min(self._size, limit)
+            size -= size % 2
+            first = min(size, self.capacity - self._head)
+            data = bytes(self._buffer[self._head:self._head + first]) + bytes(self._buffer[:size - first])
+            self._head = (self._head + size) % self.capacity
+            self._size -= size
+            self._notified = self._size >= self.chunk_bytes
+            return data
+
+    def _take_end(self) -> bool:
+        with self._lock:
+            if self._end_pending and not self._size:
+                self._end_pending = False
+                return True
+            return False
+
+    async def _run(self):
+        # Partial chunks are sent when nothing else arrives for a chunk's duration, e.g. at the end of speech
+        flush_after = self.chunk_bytes / BYTES_PER_MS / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), flush_after)
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()
+
+            while data := self._read(self.chunk_bytes * MAX_CHUNKS_PER_SEND):
+                start = time.perf_counter()
+                try:
+                    await self.send(data)
+                except Exception as e:
+                    self.logger.warning(f"Error sending audio: {e!r}")
+                    UPLINK_AUDIO_MS.inc(len(data) / BYTES_PER_MS, result="dropped")
+                    continue
+                UPLINK_SEND_SECONDS.observe(time.perf_counter() - start)
+                UPLINK_AUDIO_MS.inc(len(data) / BYTES_PER_MS, result="sent")
+                # A partial chunk waits for more audio, unless speech has ended
+                if self._size < self.chunk_bytes and not self._end_pending:
+                    break
+
+            if self.send_end is not None and self._take_end():
+                try:
+                    await self.send_end()
+                except Exception as e:
+                    self.logger.warning(f"Error ending audio stream: {e!r}")
+
+    def start(self):
+        self._task = self.loop.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        _uplinks.discard(self)
+
+
+def downmix(pcm: bytes) -> tuple[bytes, float]:
+    """Discord's 48kHz stereo to 16kHz mono, averaging both channels of every 3 samples. Also returns the RMS level"""
+    if NUMPY_AVAILABLE:
+        import numpy as np
+
+        samples = np.frombuffer(pcm, dtype=np.int16).astype(np.int32)
+        mono = samples[:len(samples) - len(samples) % DISCORD_VALUES_PER_SAMPLE].reshape(-1, DISCORD_VALUES_PER_SAMPLE).sum(axis=1) // DISCORD_VALUES_PER_SAMPLE
+        level = float(np.sqrt(np.mean(mono.astype(np.float64) ** 2))) if len(mono) else 0.0
+        return mono.astype(np.int16).tobytes(), level
+
+    values = array.array("h", pcm)
+    mono = array.array("h", [sum(group) // DISCORD_VALUES_PER_SAMPLE for group in zip(*(values[i::DISCORD_VALUES_PER_SAMPLE] for i in range(DISCORD_VALUES_PER_SAMPLE)))])
+    level = (sum(sample * sample for sample in mono) / len(mono)) ** 0.5 if mono else 0.0
+    return mono.tobytes(), level
+
+
+def mix(frames: list[bytes]) -> bytes:
+    """Sum 16 bit PCM frames, clipping instead of wrapping around"""
+    if len(frames) == 1:
+        return frames[0]
+    if NUMPY_AVAILABLE:
+        import numpy as np
+
+        length = max(len(frame) for frame in frames) // 2
+        total = np.zeros(length, dtype=np.int32)
+        for frame in frames:
+            samples = np.frombuffer(frame, dtype=np.int16)
+            total[:len(samples)] += samples
+        return np.clip(total, -32768, 32767).astype(np.int16).tobytes()
+
+    tracks = [array.array("h", frame) for frame in frames]
+    length = max(len(track) for track in tracks)
+    total = [0] * length
+    for track in tracks:
+        for i, sample in enumerate(track):
+            total[i] += sample
+    return array.array("h", [max(-32768, min(32767, sample)) for sample in total]).tobytes()
+
+
+class _Speaker:
+    def __init__(self):
+        self.frames: collections.deque[bytes] = collections.deque(maxlen=MAX_PENDING_FRAMES)
+        self.hangover = 0
+
+
+class VoiceMixer:
+    """
+    Mixes decoded Discord voice from any number of speakers into one 16kHz mono stream for an AudioUplink.
+    Frames quieter than `vad_threshold` are dropped, except for `vad_hangover_ms` after speech so words aren't cut off.
+    A speaker's frame is mixed once their next one arrives, together with whatever the others have pending.
+    Called from voice_recv's threads
+    """
+
+    def __init__(self, uplink: AudioUplink, vad_threshold: float = DEFAULT_VAD_THRESHOLD, vad_hangover_ms: int = DEFAULT_VAD_HANGOVER_MS):
+        self.uplink = uplink
+        self.vad_threshold = vad_threshold
+        self.hangover_frames = vad_hangover_ms // FRAME_MS
+        self.speakers: dict[Hashable, _Speaker] = {}
+        # Whether audio was sent since the stream was last ended
+        self.streaming = False
+        self._lock = threading.Lock()
+
+    def write(self, speaker: Hashable, pcm: bytes):
+        frame, level = downmix(pcm)
+        with self._lock:
+            state = self.speakers.setdefault(speaker, _Speaker())
+            if level >= self.vad_threshold:
+                state.hangover = self.hangover_frames
+            elif state.hangover:
+                state.hangover -= 1
+            else:
+                while state.frames:
+                    self._emit()
+                self._end_if_silent()
+                return
+
+            state.frames.append(frame)
+            self.streaming = True
+            if len(state.frames) > 1:
+                self._emit()
+
+    def stop(self, speaker: Hashable):
+        """Flush a speaker that stopped talking"""
+        with self._lock:
+            if (state := self.speakers.pop(speaker, None)) is None:
+                return
+            while state.frames:
+                self.uplink.write(mix([state.frames.popleft(), *(other.frames.popleft() for other in self.speakers.values() if other.frames)]))
+            self._end_if_silent()
+
+    def _emit(self):
+        frames = [state.frames.popleft() for state in self.speakers.values() if state.frames]
+        if frames:
+            self.uplink.write(mix(frames))
+
+    def _end_if_silent(self):
+        # Gemini is told the audio stream ended so it doesn't wait for more speech
+        if self.streaming and not any(state.hangover or state.frames for state in self.speakers.values()):
+            self.streaming = False
+            self.uplink.end_stream()
@@ -0,0 +1,118 @@
+import bisect
+from typing import Optional
+
+import discord
+
+# Discord returns at most 100 messages per history request
+MAX_HISTORY_PAGE = 100
+
+
+class ChannelHistoryWindow:
+    """
+    Contiguous slice of a channel's history, fetched a page at a time.
+    Lets back-to-back messages be chained together without a history request per message
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, before: discord.Message, page_size: int):
+        self.channel = channel
+        self.page_size = min(max(page_size, 1), MAX_HISTORY_PAGE)
+
+        # Oldest first, all messages older than `newest_id`
+        self.messages: list[discord.Message] = []
+        self.ids: list[int] = []
+        self.by_id: dict[int, discord.Message] = {}
+        self.newest_id = before.id
+        self.exhausted = False
+        self.fetches = 0
+
+    async def _fetch_page(self):
+        before = discord.Object(self.ids[0]) if self.ids else discord.Object(self.newest_id)
+        page = [m async for m in self.channel.history(before=before, limit=self.page_size, oldest_first=False)]
+        self.fetches += 1
+        if len(page) < self.page_size:
+            self.exhausted = True
+
+        page.reverse()
+        self.messages[:0] = page
+        self.ids[:0] = [m.id for m in page]
+        self.by_id.update((m.id, m) for m in page)
+
+    async def previous(self, msg: discord.Message) -> Optional[discord.Message]:
+        """The message right before `msg` in the channel, or None at the start of the channel"""
+        if msg.id > self.newest_id:
+            return None
+
+        while True:
+            index = bisect.bisect_left(self.ids, msg.id)
+            if index > 0:
+                return self.messages[index - 1]
+            if self.exhausted:
+                return None
+            await self._fetch_page()
+
+    def get(self, msg_id: int) -> Optional[discord.Message]:
+        return self.by_id.get(msg_id)
+
+    def covers(self, msg: discord.Message) -> bool:
+        return msg.id == self.newest_id or msg.id in self.by_id
+
+
+class ChainResolver:
+    """Resolves the parent of each message in a reply chain, reusing history windows and discord.py's message cache"""
+
+    def __init__(self, bot: discord.Client, page_size: int):
+        self.bot = bot
+        self.page_size = page_size
+        self.windows: dict[int, ChannelHistoryWindow] = {}
+
+        self.point_fetches = 0
+
+    @property
+    def history_fetches(self) -> int:
+        return sum(window.fetches for window in self.windows.values())
+
+    def _window(self, msg: discord.Message) -> ChannelHistoryWindow:
+        # Jumps outside the window (explicit replies to old messages) start a new one rather than paging back to them
+        if (window := self.windows.get(msg.channel.id)) is None or not window.covers(msg):
+            window = self.windows[msg.channel.id] = ChannelHistoryWindow(msg.channel, msg, self.page_size)
+        return window
+
+    def cached(self, msg_id: int) -> Optional[discord.Message]:
+        for window in self.windows.values():
+            if (msg := window.get(msg_id)) is not None:
+                return msg
+        return discord.utils.get(self.bot.cached_messages, id=msg_id)
+
+    async def fetch(self, channel: discord.abc.Messageable, msg_id: int) -> discord.Message:
+        if (msg := self.cached(msg_id)) is not None:
+            return msg
+
+        self.point_fetches += 1
+        return await channel.fetch_message(msg_id)
+
+    async def fetch_by_channel_id(self, channel_id: int, msg_id: int) -> discord.Message:
+        if (msg := self.cached(msg_id)) is not None:
+            return msg
+
+        channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+        return await self.fetch(channel, msg_id)
+
+    async def parent(self, msg: discord.Message) -> Optional[discord.Message]:
+        if msg.reference is None and self.bot.user.mention not in msg.content:
+            prev_msg_in_channel = await self._window(msg).previous(msg)
+            if (
+                prev_msg_in_channel is not None
+                and prev_msg_in_channel.type in (discord.MessageType.default, discord.MessageType.reply)
+                and prev_msg_in_channel.author == (self.bot.user if msg.channel.type == discord.ChannelType.private else msg.author)
+            ):
+                return prev_msg_in_channel
+
+        is_public_thread = msg.channel.type == discord.ChannelType.public_thread
+        parent_is_thread_start = is_public_thread and msg.reference is None and msg.channel.parent.type == discord.ChannelType.text
+
+        if parent_is_thread_start:
+            return msg.channel.starter_message or await self.fetch(msg.channel.parent, msg.channel.id)
+        elif parent_msg_id := getattr(msg.reference, "message_id", None):
+            return msg.reference.cached_message or await self.fetch(msg.channel, parent_msg_id)
+
+        return None
@@ -1,60 +1,77 @@
-import functools
 import logging
-import typing
+from typing import Optional
 
 import discord
+from discord.app_commands import Choice
 from discord.ext import commands
 import httpx
 from pydantic_ai.messages import ModelRequest, ModelResponse, SystemPromptPart, TextPart
 
-from .spec import load_card, TavernCardV1, TavernCardV2
-from llmcord import MsgNode
+from config import current_config
+from .library import CardCache, CardLibrary, DEFAULT_LIBRARY_PATH
+from .lorebook import Lorebook
+from .spec import CardTooLarge, MAX_CARD_BYTES
+from msg_cache import MsgNodeCache
+from msg_node import MsgNode
 
 
 class CharacterCardCog(commands.Cog):
-    http_client = httpx.AsyncClient()
-
-    def __init__(self, bot: discord.ext.commands.Bot, cache: dict[typing.Any, "MsgNode"], *args, **kwargs):
+    def __init__(self, bot: discord.ext.commands.Bot, cache: MsgNodeCache, http_client: httpx.AsyncClient, library_path: str = DEFAULT_LIBRARY_PATH, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.bot = bot
         self.cache = cache
+        self.http_client = http_client
+        self.cards = CardCache()
+        self.library = CardLibrary(library_path)
 
     @discord.app_commands.command(description="Use a character card")
-    async def character(self, interaction: discord.Interaction, file: discord.Attachment) -> None:
-        if not file.content_type == "image/png":
-            await interaction.response.send_message("Character card file must be PNG", ephemeral=True)
+    @discord.app_commands.describe(
+        file="Character card PNG",
+        name="Card from the library, or the name to save the uploaded card as (admins only)",
+    )
+    async def character(self, interaction: discord.Interaction, file: Optional[discord.Attachment] = None, name: Optional[str] = None) -> None:
+        if file is None and name is None:
+            await interaction.response.send_message("Upload a card or pick one from the library", ephemeral=True)
             return
-
-        logging.info(f"Loading model card...")
-        content = (await self.http_client.get(file.url)).content
-        character_card = load_card(content)
-        if not character_card:
-            await interaction.response.send_message("File is not a character card", ephemeral=True)
+        if name is not None and not self.library.valid_name(name):
+            await interaction.response.send_message("Card names can only have letters, numbers, spaces, - and _", ephemeral=True)
+            return
+        if file is not None and name is not None and interaction.user.id not in current_config().admin_ids:
+            await interaction.response.send_message("Only admins can save cards to the library", ephemeral=True)
             return
 
-        if isinstance(character_card.root, TavernCardV1):
-            character_card = character_card.to_v2()
-        else:
-            character_card = character_card.root
+        if file is not None:
+            if not file.content_type == "image/png":
+                await interaction.response.send_message("Character card file must be PNG", ephemeral=True)
+                return
+            if file.size > MAX_CARD_BYTES:
+                await interaction.response.send_message("Character card file is too large", ephemeral=True)
+                return
 
-        character_card = typing.cast(TavernCardV2, character_card)
-        system_prompt = []
+            logging.info(f"Loading model card...")
+            content = (await self.http_client.get(file.url)).content
+        elif (content := await self.library.get(name)) is None:
+            await interaction.response.send_message(f"There's no card named {name}", ephemeral=True)
+            return
 
-        templatize = functools.partial(character_card.data.templatize, username=interaction.user.mention)
+        try:
+            parsed = await self.cards.load(content)
+        except CardTooLarge:
+            await interaction.response.send_message("Character card file is too large", ephemeral=True)
+            return
+        if not parsed:
+            await interaction.response.send_message("File is not a character card", ephemeral=True)
+            return
 
-        if character_card.data.system_prompt:
-            system_prompt.append(templatize(character_card.data.system_prompt))
-        if character_card.data.description:
-            system_prompt.append(templatize(character_card.data.description))
-        if character_card.data.personality:
-            system_prompt.append(f"{character_card.data.name}'s personality: {templatize(character_card.data.personality)}")
-        if character_card.data.scenario:
-            system_prompt.append(templatize(character_card.data.scenario))
-        # TODO: mes_example
+        if file is not None and name is not None:
+            await self.library.save(name, content)
 
-        system_prompt = "\n".join(system_prompt)
+        system_prompt, lorebook = parsed.render(interaction.user.mention)
+        if lorebook is not None:
+            await self.library.save_digest(parsed.digest, content)
+        first_mes = parsed.card.data.templatize(parsed.card.data.first_mes, username=interaction.user.mention)
 
-        prompt = await interaction.response.send_message(templatize(character_card.data.first_mes))
+        prompt = await interaction.response.send_message(first_mes)
         self.cache[prompt.message_id] = MsgNode(
             msg=[
                 ModelRequest(
@@ -65,9 +82,26 @@ class CharacterCardCog(commands.Cog):
                 ),
                 ModelResponse(
                     parts=[
-                        TextPart(content=templatize(character_card.data.first_mes)),
+                        TextPart(content=first_mes),
                     ],
                 )
             ],
             override_system_prompt=True,
+            lorebook=lorebook,
+            card_digest=parsed.digest if lorebook is not None else None,
+            card_user=interaction.user.mention,
         )
+
+    async def lorebook(self, digest: str, username: str) -> Optional[Lorebook]:
+        """Rebuild the lorebook of a card node that was evicted or loaded from the store"""
+        if (parsed := self.cards.get(digest)) is None:
+            if (content := await self.library.get_digest(digest)) is None:
+                logging.warning(f"Character card {digest} is gone, its lorebook can't be used")
+                return None
+            if (parsed := await self.cards.load(content)) is None:
+                return None
+        return parsed.render(username)[1]
+
+    @character.autocomplete("name")
+    async def name_autocomplete(self, interaction: discord.Interaction, curr_str: str) -> list[Choice[str]]:
+        return [Choice(name=name, value=name) for name in self.library.names() if curr_str.lower() in name.lower()][:25]
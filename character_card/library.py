@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import dataclasses
+import functools
+import hashlib
+import logging
+import os
+import re
+import typing
+from typing import Optional
+
+from .lorebook import Lorebook
+from .spec import load_card, TavernCardV1, TavernCardV2
+
+DEFAULT_LIBRARY_PATH = "character_cards"
+# Cards with a lorebook are also kept here by digest, so lorebooks of stored conversations can be rebuilt
+DIGEST_DIRECTORY = "by_digest"
+MAX_CACHED_CARDS = 32
+NAME_RE = re.compile(r"^[\w\- ]{1,64}$")
+DIGEST_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+@dataclasses.dataclass
+class ParsedCard:
+    """A parsed card with its system prompt and lorebook, rendered once per user"""
+    card: TavernCardV2
+    digest: str
+    _rendered: dict[str, tuple[str, Optional[Lorebook]]] = dataclasses.field(default_factory=dict)
+
+    def render(self, username: str) -> tuple[str, Optional[Lorebook]]:
+        if (rendered := self._rendered.get(username)) is None:
+            data = self.card.data
+            templatize = functools.partial(data.templatize, username=username)
+
+            system_prompt = []
+            if data.system_prompt:
+                system_prompt.append(templatize(data.system_prompt))
+            if data.description:
+                system_prompt.append(templatize(data.description))
+            if data.personality:
+                system_prompt.append(f"{data.name}'s personality: {templatize(data.personality)}")
+            if data.scenario:
+                system_prompt.append(templatize(data.scenario))
+            # TODO: mes_example
+
+            lorebook = Lorebook(data.character_book, templatize) if data.character_book else None
+            rendered = self._rendered[username] = ("\n".join(system_prompt), lorebook)
+        return rendered
+
+
+class CardCache:
+    """Parsed cards by SHA-256 of the PNG, least recently used ones are dropped past `max_size`"""
+
+    def __init__(self, max_size: int = MAX_CACHED_CARDS):
+        self.max_size = max_size
+        self.cards: collections.OrderedDict[str, ParsedCard] = collections.OrderedDict()
+
+    def get(self, digest: str) -> Optional[ParsedCard]:
+        if (parsed := self.cards.get(digest)) is not None:
+            self.cards.move_to_end(digest)
+        return parsed
+
+    @staticmethod
+    def _parse(content: bytes) -> Optional[TavernCardV2]:
+        if (card := load_card(content)) is None:
+            return None
+        return card.root.to_v2() if isinstance(card.root, TavernCardV1) else typing.cast(TavernCardV2, card.root)
+
+    async def load(self, content: bytes) -> Optional[ParsedCard]:
+        """Parse a card PNG off the event loop, unless the same file was parsed before. Raises CardTooLarge"""
+        digest = await asyncio.to_thread(lambda: hashlib.sha256(content).hexdigest())
+        if (parsed := self.get(digest)) is not None:
+            return parsed
+
+        if (card := await asyncio.to_thread(self._parse, content)) is None:
+            return None
+        parsed = self.cards[digest] = ParsedCard(card, digest)
+        while len(self.cards) > self.max_size:
+            self.cards.popitem(last=False)
+        return parsed
+
+
+class CardLibrary:
+    """Named card PNGs saved in a directory, so cards can be switched without uploading them again"""
+
+    def __init__(self, path: str = DEFAULT_LIBRARY_PATH):
+        self.path = path
+
+    @staticmethod
+    def valid_name(name: str) -> bool:
+        return bool(NAME_RE.match(name))
+
+    def _file(self, name: str) -> str:
+        if not self.valid_name(name):
+            raise ValueError(f"Invalid card name {name!r}")
+        return os.path.join(self.path, f"{name}.png")
+
+    def _digest_file(self, digest: str) -> str:
+        if not DIGEST_RE.match(digest):
+            raise ValueError(f"Invalid card digest {digest!r}")
+        return os.path.join(self.path, DIGEST_DIRECTORY, f"{digest}.png")
+
+    @staticmethod
+    def _save(file: str, content: bytes):
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # Written to a temporary file first so other workers never read a partial card
+        tmp = file + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(content)
+        os.replace(tmp, file)
+
+    @staticmethod
+    def _read(file: str) -> Optional[bytes]:
+        try:
+            with open(file, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def names(self) -> list[str]:
+        try:
+            return sorted(file.removesuffix(".png") for file in os.listdir(self.path) if file.endswith(".png"))
+        except FileNotFoundError:
+            return []
+
+    async def save(self, name: str, content: bytes):
+        await asyncio.to_thread(self._save, self._file(name), content)
+        logging.info(f"Saved character card {name!r}")
+
+    async def get(self, name: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, self._file(name))
+
+    async def save_digest(self, digest: str, content: bytes):
+        if not await asyncio.to_thread(os.path.exists, self._digest_file(digest)):
+            await asyncio.to_thread(self._save, self._digest_file(digest), content)
+
+    async def get_digest(self, digest: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, self._digest_file(digest))
@@ -0,0 +1,129 @@
+import dataclasses
+import re
+from typing import Callable, Iterable, Optional
+
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, SystemPromptPart, TextPart, UserPromptPart
+
+from msg_node import MsgNode
+from token_budget import estimate_text_tokens
+from .spec import CharacterBook
+
+# Messages scanned for keys when the book doesn't set scan_depth
+DEFAULT_SCAN_DEPTH = 2
+
+# (entry index, whether it's a secondary key)
+Hit = tuple[int, bool]
+
+
+class _KeyMatcher:
+    """
+    Finds every whole-word occurrence of any key in one pass of a combined regex.
+    At each position the regex reports the longest key, shorter keys that are a prefix of it are added from a table
+    """
+
+    def __init__(self, keys: dict[str, set[Hit]], case_sensitive: bool):
+        self.case_sensitive = case_sensitive
+        self.hits = keys
+        self.prefixes: dict[str, list[str]] = {
+            key: [key[:end] for end in range(1, len(key)) if key[:end] in keys and not key[end].isalnum() and key[end] != "_"]
+            for key in keys
+        }
+        alternatives = "|".join(re.escape(key) for key in sorted(keys, key=len, reverse=True))
+        self.pattern = re.compile(rf"(?<!\w)(?=({alternatives})(?!\w))", 0 if case_sensitive else re.IGNORECASE)
+
+    def scan(self, text: str) -> set[Hit]:
+        hits = set()
+        for match in self.pattern.finditer(text):
+            key = match.group(1) if self.case_sensitive else match.group(1).lower()
+            hits.update(self.hits[key])
+            for prefix in self.prefixes[key]:
+                hits.update(self.hits[prefix])
+        return hits
+
+
+def _message_text(messages: Optional[list[ModelMessage]]) -> str:
+    texts = []
+    for message in messages or ():
+        for part in message.parts:
+            if isinstance(message, ModelRequest) and isinstance(part, UserPromptPart):
+                texts.extend([part.content] if isinstance(part.content, str) else (item for item in part.content if isinstance(item, str)))
+            elif isinstance(message, ModelResponse) and isinstance(part, TextPart):
+                texts.append(part.content)
+    return "\n".join(texts)
+
+
+class Lorebook:
+    """
+    A card's character book. Keys are compiled once, each MsgNode is scanned once and its hits are kept on the node,
+    so a turn only scans messages that weren't seen before
+    """
+
+    def __init__(self, book: CharacterBook, templatize: Callable[[str], str]):
+        self.entries = [entry for entry in book.entries if entry.enabled]
+        self.scan_depth = book.scan_depth if book.scan_depth is not None else DEFAULT_SCAN_DEPTH
+        self.token_budget = book.token_budget
+        self.contents = [templatize(entry.content) for entry in self.entries]
+
+        keys: dict[bool, dict[str, set[Hit]]] = {True: {}, False: {}}
+        for index, entry in enumerate(self.entries):
+            case_sensitive = bool(entry.case_sensitive)
+            for secondary, entry_keys in ((False, entry.keys), (True, entry.secondary_keys or [])):
+                for key in entry_keys:
+                    if key := key.strip():
+                        keys[case_sensitive].setdefault(key if case_sensitive else key.lower(), set()).add((index, secondary))
+        self.matchers = [_KeyMatcher(group, case_sensitive) for case_sensitive, group in keys.items() if group]
+
+    def scan(self, node: MsgNode) -> frozenset[Hit]:
+        if node.lore_hits is None:
+            text = _message_text(node.msg)
+            node.lore_hits = frozenset(hit for matcher in self.matchers for hit in matcher.scan(text))
+        return node.lore_hits
+
+    def activate(self, nodes: Iterable[MsgNode]) -> list[int]:
+        """Indexes of entries triggered by the newest `scan_depth` nodes, within the token budget, in insertion order"""
+        hits = set()
+        for depth, node in enumerate(nodes):
+            if depth >= self.scan_depth:
+                break
+            hits |= self.scan(node)
+
+        active = [
+            index for index, entry in enumerate(self.entries)
+            if entry.constant or (index, False) in hits and (not entry.selective or not entry.secondary_keys or (index, True) in hits)
+        ]
+        # Lower priority entries are the first to go when over budget
+        active.sort(key=lambda index: (-(self.entries[index].priority or 0), self.entries[index].insertion_order))
+
+        selected, used_tokens = [], 0
+        for index in active:
+            tokens = estimate_text_tokens(self.contents[index])
+            if self.token_budget is not None and used_tokens + tokens > self.token_budget:
+                continue
+            used_tokens += tokens
+            selected.append(index)
+
+        selected.sort(key=lambda index: self.entries[index].insertion_order)
+        return selected
+
+    def apply(self, messages: list[ModelMessage], card_node: MsgNode, nodes: Iterable[MsgNode]) -> list[ModelMessage]:
+        """Put active entries around the card's system prompt. The cached messages aren't modified"""
+        active = self.activate(nodes)
+        if not active:
+            return messages
+
+        before = "\n".join(self.contents[index] for index in active if self.entries[index].position != "after_char")
+        after = "\n".join(self.contents[index] for index in active if self.entries[index].position == "after_char")
+
+        def with_lore(message: ModelMessage) -> ModelMessage:
+            is_card_prompt = any(message is card_message for card_message in card_node.msg) and isinstance(message, ModelRequest) \
+                and any(isinstance(part, SystemPromptPart) for part in message.parts)
+            if not is_card_prompt:
+                return message
+            parts = [
+                *([SystemPromptPart(content=before)] if before else []),
+                *message.parts,
+                *([SystemPromptPart(content=after)] if after else []),
+            ]
+            return dataclasses.replace(message, parts=parts)
+
+        return [with_lore(message) for message in messages]
@@ -1,21 +1,65 @@
 import base64
+import json
 import re
+import struct
+import zlib
 from typing import Optional, List, Dict, Any, Union, Literal, Annotated
 import pydantic
-import png
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# Larger files and card chunks are refused rather than read
+MAX_CARD_BYTES = 20 * 1024 * 1024
+MAX_CARD_CHUNK_BYTES = 8 * 1024 * 1024
+# V3 cards also carry a V2 `chara` chunk for older readers, whichever comes first is used
+CARD_CHUNK_KEYWORDS = (b"ccv3", b"chara")
+
+
+class CardTooLarge(Exception):
+    pass
+
+
+def _text_chunks(b: bytes):
+    """
+    Yield (keyword, text) of the tEXt chunks of a PNG. Only chunk headers are read,
+    image data is skipped without being decompressed or checksummed
+    """
+    if not b.startswith(PNG_SIGNATURE):
+        return
+    offset = len(PNG_SIGNATURE)
+    while offset + 8 <= len(b):
+        length, chunk_type = struct.unpack_from(">I4s", b, offset)
+        data_start = offset + 8
+        offset = data_start + length + 4
+        if chunk_type == b"IEND" or offset > len(b):
+            return
+        if chunk_type != b"tEXt":
+            continue
+        if length > MAX_CARD_CHUNK_BYTES:
+            raise CardTooLarge(f"{length} byte text chunk")
+
+        data = b[data_start:data_start + length]
+        if struct.unpack_from(">I", b, data_start + length)[0] != zlib.crc32(data, zlib.crc32(chunk_type)):
+            continue
+        keyword, _, text = data.partition(b"\0")
+        yield keyword, text
 
 
 def load_card(b: bytes) -> Union["TavernCard", None]:
-    reader = png.Reader(bytes=b)
-    for chunk_type, content in reader.chunks():
-        if chunk_type == b"tEXt":
-            prefix = b"chara\00"
-            if content.startswith(prefix):
-                json_content = base64.b64decode(content[len(prefix):])
-                try:
-                    return TavernCard.model_validate_json(json_content)
-                except pydantic.ValidationError:
-                    continue
+    """The first valid card embedded in a PNG. Blocking, run it off the event loop"""
+    if len(b) > MAX_CARD_BYTES:
+        raise CardTooLarge(f"{len(b)} byte file")
+
+    for keyword, text in _text_chunks(b):
+        if keyword not in CARD_CHUNK_KEYWORDS:
+            continue
+        try:
+            card = json.loads(base64.b64decode(text))
+            if keyword == b"ccv3" and isinstance(card, dict):
+                # V3 data is a superset of V2's, the extra fields are ignored
+                card = {"spec": "chara_card_v2", "spec_version": "2.0", "data": card.get("data")}
+            return TavernCard.model_validate(card)
+        except (ValueError, pydantic.ValidationError):
+            continue
 
 class CharacterBookEntry(pydantic.BaseModel):
     keys: List[str]
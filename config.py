@@ -1,11 +1,131 @@
-from typing import Any
+import asyncio
+import dataclasses
+import logging
+import os
+from typing import Any, Optional
 
 import yaml
 
+from summarizer import DEFAULT_SUMMARY_THRESHOLD
 
-def get_config(filename: str = "config.yaml") -> dict[str, Any]:
+CONFIG_FILENAME = "config.yaml"
+CONFIG_RELOAD_INTERVAL_SECONDS = 5
+
+
+@dataclasses.dataclass(frozen=True)
+class ConfigSnapshot:
+    """Validated, immutable view of config.yaml. Replaced as a whole on reload"""
+    data: dict[str, Any]
+    version: int
+    mtime: float
+
+    admin_ids: frozenset[int]
+    allowed_user_ids: frozenset[int]
+    blocked_user_ids: frozenset[int]
+    allowed_role_ids: frozenset[int]
+    blocked_role_ids: frozenset[int]
+    allowed_channel_ids: frozenset[int]
+    blocked_channel_ids: frozenset[int]
+
+    def __getitem__(self, key: str) -> Any:
+        return self.data[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.data
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.data.get(key, default)
+
+
+_snapshot: Optional[ConfigSnapshot] = None
+
+
+def get_config(filename: str = CONFIG_FILENAME) -> dict[str, Any]:
     with open(filename, encoding="utf-8") as file:
         return yaml.safe_load(file)
 
 
-config = get_config()
+def _id_set(section: dict, key: str) -> frozenset[int]:
+    return frozenset(int(id) for id in (section.get(key) or ()))
+
+
+def build_snapshot(data: Any, version: int = 0, mtime: float = 0) -> ConfigSnapshot:
+    if not isinstance(data, dict):
+        raise ValueError("Config must be a mapping")
+
+    providers = data.get("providers") or {}
+    models = data.get("models") or {}
+    if not models:
+        raise ValueError("Config must define at least one model")
+    for provider_slash_model in models:
+        provider = provider_slash_model.split("/", 1)[0]
+        if provider not in providers:
+            raise ValueError(f"Model {provider_slash_model} uses unknown provider {provider}")
+        for fallback in (models[provider_slash_model] or {}).get("fallbacks") or ():
+            if fallback.split("/", 1)[0] not in providers:
+                raise ValueError(f"Fallback {fallback} of model {provider_slash_model} uses unknown provider")
+
+    if summarization := data.get("summarization"):
+        if not isinstance(summarization, dict) or "/" not in str(summarization.get("model", "")):
+            raise ValueError("summarization.model must be set in <provider>/<model> format")
+        if (provider := summarization["model"].split("/", 1)[0]) not in providers:
+            raise ValueError(f"Summarization model uses unknown provider {provider}")
+        # The summary has to be made before the oldest messages fall out of the chain
+        if summarization.get("threshold", DEFAULT_SUMMARY_THRESHOLD) >= data.get("max_messages", 25):
+            raise ValueError("summarization.threshold must be less than max_messages")
+
+    if (sharding := data.get("sharding")) and sharding.get("shard_ids") and not sharding.get("shard_count"):
+        raise ValueError("sharding.shard_count must be set when shard_ids are")
+
+    permissions = data.get("permissions") or {}
+    users, roles, channels = (permissions.get(name) or {} for name in ("users", "roles", "channels"))
+
+    return ConfigSnapshot(
+        data=data,
+        version=version,
+        mtime=mtime,
+        admin_ids=_id_set(users, "admin_ids"),
+        allowed_user_ids=_id_set(users, "allowed_ids"),
+        blocked_user_ids=_id_set(users, "blocked_ids"),
+        allowed_role_ids=_id_set(roles, "allowed_ids"),
+        blocked_role_ids=_id_set(roles, "blocked_ids"),
+        allowed_channel_ids=_id_set(channels, "allowed_ids"),
+        blocked_channel_ids=_id_set(channels, "blocked_ids"),
+    )
+
+
+def reload_config(filename: str = CONFIG_FILENAME, force: bool = False) -> bool:
+    """
+    Reload the config if the file changed since the last snapshot.
+    On failure the last good snapshot stays active. Returns whether a new snapshot was installed
+    """
+    global _snapshot
+
+    try:
+        mtime = os.stat(filename).st_mtime
+        if not force and _snapshot is not None and mtime == _snapshot.mtime:
+            return False
+
+        snapshot = build_snapshot(get_config(filename), version=_snapshot.version + 1 if _snapshot else 0, mtime=mtime)
+    except Exception:
+        if _snapshot is None:
+            raise
+        logging.exception("Error reloading config, keeping the previous version")
+        return False
+
+    _snapshot = snapshot
+    if snapshot.version > 0:
+        logging.info(f"Config reloaded (version {snapshot.version})")
+    return True
+
+
+def current_config() -> ConfigSnapshot:
+    if _snapshot is None:
+        reload_config()
+    return _snapshot
+
+
+async def watch_config(filename: str = CONFIG_FILENAME, interval: float = CONFIG_RELOAD_INTERVAL_SECONDS) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(reload_config, filename)
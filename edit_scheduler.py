@@ -0,0 +1,123 @@
+import asyncio
+import dataclasses
+import logging
+from typing import Any, Callable, Optional
+
+import discord
+from discord.http import Route
+
+from metrics import DISCORD_EDITS, DISCORD_EDIT_SECONDS
+
+DEFAULT_EDIT_INTERVAL_SECONDS = 1
+MIN_EDIT_INTERVAL_SECONDS = 0.2
+
+
+@dataclasses.dataclass
+class _PendingEdit:
+    message: discord.Message
+    # Called when the edit is sent, so only the latest content is ever rendered
+    render: Callable[[], dict[str, Any]]
+    priority: bool
+    future: asyncio.Future
+
+
+class _ChannelEditQueue:
+    def __init__(self, scheduler: "EditScheduler", channel_id: int):
+        self.scheduler = scheduler
+        self.channel_id = channel_id
+        # Keyed by message ID, a newer edit of the same message replaces the pending one
+        self.pending: dict[int, _PendingEdit] = {}
+        self.wakeup = asyncio.Event()
+        self.next_edit_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+
+    def submit(self, edit: _PendingEdit):
+        if (superseded := self.pending.get(edit.message.id)) is not None:
+            edit.priority = edit.priority or superseded.priority
+            # The caller may have been cancelled while waiting for it
+            if not superseded.future.done():
+                superseded.future.set_result(False)
+            DISCORD_EDITS.inc(result="superseded")
+        self.pending[edit.message.id] = edit
+
+        if edit.priority:
+            self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message_id = next((key for key, edit in self.pending.items() if edit.priority), None)
+            if message_id is None:
+                if (delay := self.next_edit_at - loop.time()) > 0:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if not self.pending:
+                    # Drained and past the interval, so the next edit doesn't have to wait for this queue
+                    break
+                message_id = next(iter(self.pending))
+
+            edit = self.pending.pop(message_id)
+            try:
+                with DISCORD_EDIT_SECONDS.time():
+                    await edit.message.edit(**edit.render())
+                if not edit.future.done():
+                    edit.future.set_result(True)
+                DISCORD_EDITS.inc(result="sent")
+            except Exception:
+                logging.exception("Error editing message")
+                if not edit.future.done():
+                    edit.future.set_result(False)
+                DISCORD_EDITS.inc(result="failed")
+
+            self.next_edit_at = loop.time() + self.scheduler.interval_for(self.channel_id)
+
+        # Idle channels don't keep a queue
+        if self.scheduler.queues.get(self.channel_id) is self:
+            del self.scheduler.queues[self.channel_id]
+
+
+class EditScheduler:
+    """
+    Schedules message edits per channel, which is the rate limit bucket Discord applies to them.
+    Pending edits of a message are coalesced (latest wins), priority edits (final and forced flushes)
+    skip the queue and the interval adapts to the X-RateLimit-* state discord.py tracks for the bucket
+    """
+
+    def __init__(self, client: discord.Client, default_interval: float = DEFAULT_EDIT_INTERVAL_SECONDS, min_interval: float = MIN_EDIT_INTERVAL_SECONDS):
+        self.client = client
+        self.default_interval = default_interval
+        self.min_interval = min_interval
+        self.queues: dict[int, _ChannelEditQueue] = {}
+
+    def edit(self, message: discord.Message, render: Callable[[], dict[str, Any]], priority: bool = False) -> asyncio.Future:
+        """Schedule an edit. The future resolves to whether this edit was sent (False if superseded or failed)"""
+        future = asyncio.get_running_loop().create_future()
+        channel_id = message.channel.id
+        if (queue := self.queues.get(channel_id)) is None:
+            queue = self.queues[channel_id] = _ChannelEditQueue(self, channel_id)
+        queue.submit(_PendingEdit(message, render, priority, future))
+        return future
+
+    def _ratelimit(self, channel_id: int):
+        # discord.py doesn't expose rate limit state publicly, fall back to the default interval if this changes
+        http = self.client.http
+        route = Route("PATCH", "/channels/{channel_id}/messages/{message_id}", channel_id=channel_id, message_id=0)
+        bucket_hash = getattr(http, "_bucket_hashes", {}).get(route.key, route.key)
+        return getattr(http, "_buckets", {}).get(f"{bucket_hash}:{route.major_parameters}")
+
+    def interval_for(self, channel_id: int) -> float:
+        ratelimit = self._ratelimit(channel_id)
+        if ratelimit is None or getattr(ratelimit, "expires", None) is None:
+            return self.default_interval
+
+        # Spread the remaining requests over the time left in the window
+        time_left = ratelimit.expires - asyncio.get_running_loop().time()
+        if time_left <= 0:
+            return self.min_interval
+        return max(time_left / max(ratelimit.remaining, 1), self.min_interval)
@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import dataclasses
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+# Circuit breaker: a provider is skipped for COOLDOWN_SECONDS after MAX_CONSECUTIVE_FAILURES failures in a row,
+# or when at least FAILURE_RATE of its last WINDOW requests (MIN_SAMPLES or more) failed. Slow requests are only counted
+WINDOW = 20
+MIN_SAMPLES = 5
+FAILURE_RATE = 0.5
+MAX_CONSECUTIVE_FAILURES = 3
+COOLDOWN_SECONDS = 30
+TTFT_SMOOTHING = 0.2
+
+
+def provider_of(provider_slash_model: str) -> str:
+    return provider_slash_model.split("/", 1)[0]
+
+
+@dataclasses.dataclass
+class ProviderStats:
+    outcomes: collections.deque[bool] = dataclasses.field(default_factory=lambda: collections.deque(maxlen=WINDOW))
+    consecutive_failures: int = 0
+    requests: int = 0
+    failures: int = 0
+    # Requests that lost to a hedge because their first token took too long
+    slow: int = 0
+    ttft_seconds: Optional[float] = None
+    open_until: float = 0.0
+
+
+class ProviderHealth:
+    """Per-provider error and time to first token statistics, with a circuit breaker on top"""
+
+    def __init__(self):
+        self.providers: collections.defaultdict[str, ProviderStats] = collections.defaultdict(ProviderStats)
+
+    def available(self, provider: str) -> bool:
+        # Once the cooldown is over requests go through again, the next failure reopens the circuit
+        return time.monotonic() >= self.providers[provider].open_until
+
+    def record_success(self, provider: str, ttft: float):
+        stats = self.providers[provider]
+        stats.requests += 1
+        stats.outcomes.append(True)
+        stats.consecutive_failures = 0
+        stats.ttft_seconds = ttft if stats.ttft_seconds is None else stats.ttft_seconds + TTFT_SMOOTHING * (ttft - stats.ttft_seconds)
+
+    def record_slow(self, provider: str):
+        """Record a request that lost to a hedge. It may well have succeeded, so it doesn't count towards the circuit breaker"""
+        stats = self.providers[provider]
+        stats.requests += 1
+        stats.slow += 1
+
+    def record_failure(self, provider: str):
+        stats = self.providers[provider]
+        stats.outcomes.append(False)
+        stats.requests += 1
+        stats.failures += 1
+        stats.consecutive_failures += 1
+
+        failure_rate = stats.outcomes.count(False) / len(stats.outcomes)
+        if stats.consecutive_failures >= MAX_CONSECUTIVE_FAILURES or (len(stats.outcomes) >= MIN_SAMPLES and failure_rate >= FAILURE_RATE):
+            stats.open_until = time.monotonic() + COOLDOWN_SECONDS
+            stats.outcomes.clear()
+            logging.warning(f"Provider {provider} is failing, skipping it for {COOLDOWN_SECONDS} seconds")
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        return {
+            provider: {
+                "requests": stats.requests,
+                "failures": stats.failures,
+                "slow": stats.slow,
+                "ttft_seconds": stats.ttft_seconds,
+                "open": not self.available(provider),
+            }
+            for provider, stats in self.providers.items()
+        }
+
+
+class FailoverRunner:
+    """
+    Runs a request against candidate models in order. The next candidate starts when one fails before streaming anything,
+    or alongside it (hedging) when its first event takes longer than `hedge_after` seconds.
+    Attempts call `claim()` on each event: the first attempt to do so wins and the others are cancelled
+    """
+
+    def __init__(self, candidates: list[str], attempt: Callable[[str, Callable[[], bool]], Awaitable[Any]], health: ProviderHealth, hedge_after: Optional[float] = None):
+        self.candidates = candidates
+        self.attempt = attempt
+        self.health = health
+        self.hedge_after = hedge_after
+
+    async def run(self) -> Any:
+        loop = asyncio.get_running_loop()
+        pending = list(self.candidates)
+        running: dict[asyncio.Task, str] = {}
+        # Attempts that were still waiting for their first event when a hedge started
+        hedged: set[asyncio.Task] = set()
+        winner: Optional[asyncio.Task] = None
+
+        def start():
+            model = pending.pop(0)
+            started_at = loop.time()
+            task: Optional[asyncio.Task] = None
+
+            def claim() -> bool:
+                nonlocal winner
+                if winner is None:
+                    winner = task
+                    self.health.record_success(provider_of(model), loop.time() - started_at)
+                    for other, other_model in running.items():
+                        if other is not task:
+                            if other in hedged:
+                                self.health.record_slow(provider_of(other_model))
+                            other.cancel()
+                return winner is task
+
+            task = asyncio.create_task(self.attempt(model, claim))
+            running[task] = model
+
+        start()
+        try:
+            while True:
+                hedge_after = self.hedge_after if pending and winner is None else None
+                done, _ = await asyncio.wait(running, timeout=hedge_after, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged.update(running)
+                    logging.info(f"No response from {', '.join(running.values())} after {hedge_after}s, also trying {pending[0]}")
+                    start()
+                    continue
+
+                for task in done:
+                    model = running.pop(task)
+                    if task.cancelled():
+                        continue
+                    if task is winner or winner is None and task.exception() is None:
+                        # Errors after the first event are not retried, part of the response has been shown
+                        return task.result()
+
+                    self.health.record_failure(provider_of(model))
+                    logging.warning(f"Error from {model}: {task.exception()!r}")
+                    if not running and winner is None:
+                        if not pending:
+                            raise task.exception()
+                        start()
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
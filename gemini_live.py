@@ -1,5 +1,4 @@
 import asyncio
-import io
 import logging
 from typing import Optional
 
@@ -7,14 +6,16 @@ import discord
 from discord.ext import voice_recv, commands
 from google import genai
 from google.genai import types, live
-from queuepipeio import PipeWriter, PipeReader
 
-from config import config
+from audio_playback import DEFAULT_PREFILL_MS, GeminiAudioSource
+from audio_uplink import AudioUplink, DEFAULT_BUFFER_MS, DEFAULT_CHUNK_MS, DEFAULT_VAD_HANGOVER_MS, DEFAULT_VAD_THRESHOLD, VoiceMixer
+from config import current_config
 
 
 @discord.app_commands.command(name="live", description="Make the bot join your voice channel")
 async def live_command(interaction: discord.Interaction) -> None:
-    if interaction.user.id not in config["permissions"]["users"]["admin_ids"]:
+    config = current_config()
+    if interaction.user.id not in config.admin_ids:
         await interaction.response.send_message("You are not admin", ephemeral=True)
         return
 
@@ -69,50 +70,64 @@ class GeminiLiveConnection:
             self.logger.info("Gemini connected")
             self.session = session
 
-            sink = voice_recv.SilenceGeneratorSink(_GeminiFFmpegSink(session, asyncio.get_running_loop()))
-            self.voice_conn.listen(sink)
-
-            while self.voice_conn.is_listening():
-                bot_output_w = PipeWriter(chunk_size=io.DEFAULT_BUFFER_SIZE)
-                bot_output_r = PipeReader()
-                bot_output_w.connect(bot_output_r)
-
-                # play_future = asyncio.get_running_loop().create_future()
-                # I can't get this to unbuffer (it seems that many place has io.DEFAULT_BUFFER_SIZE hardcoded)
-                # so just recreate ffmpeg every time ensure that it will flush
-                audio_source = discord.FFmpegOpusAudio(bot_output_r, pipe=True, before_options=f"-f s16le -ar 24000")
-                # self.voice_conn.play(
-                #     audio_source,
-                #     # after=play_future.set_result,
-                #     application="voip", signal_type="voice"
-                # )
-
-                async for response in session.receive():
-                    if not response:
-                        break
-
-                    response_data = response.data
-                    if response.server_content.interrupted is True:
-                        self.logger.info("Turn interrupted")
-                        # Flush audio source
-                        self.voice_conn.stop_playing()
-                        break
-                    elif response_data is not None:
-                        bot_output_w.write(response_data)
-
-                        if self.voice_conn.source != audio_source:
-                            self.voice_conn.stop_playing()
-                            self.voice_conn.play(audio_source, application="voip", signal_type="voice")
-                    elif response.go_away is not None:
-                        await self.session.send_realtime_input(text=f"System: Time left in this session is {response.go_away.time_left}")
-                    else:
-                        self.logger.debug("Gemini response", response)
-
-                bot_output_w.close()
-                self.logger.info("Turn ended")
+            async def send_audio(data: bytes):
+                await session.send_realtime_input(audio=types.Blob(data=data, mime_type="audio/pcm;rate=16000"))
+
+            async def end_audio():
+                await session.send_realtime_input(audio_stream_end=True)
+
+            uplink = AudioUplink(
+                send_audio, asyncio.get_running_loop(),
+                chunk_ms=self.config.get("uplink_chunk_ms", DEFAULT_CHUNK_MS),
+                buffer_ms=self.config.get("uplink_buffer_ms", DEFAULT_BUFFER_MS),
+                send_end=end_audio,
+            )
+            uplink.start()
+            sink = _GeminiVoiceSink(VoiceMixer(
+                uplink,
+                vad_threshold=self.config.get("vad_threshold", DEFAULT_VAD_THRESHOLD),
+                vad_hangover_ms=self.config.get("vad_hangover_ms", DEFAULT_VAD_HANGOVER_MS),
+            ))
+            try:
+                self.voice_conn.listen(sink)
+
+                playback = GeminiAudioSource(
+                    lambda: self.loop.call_soon_threadsafe(self._pause_if_idle, playback),
+                    prefill_ms=self.config.get("playback_prefill_ms", DEFAULT_PREFILL_MS),
+                )
+                while self.voice_conn.is_listening():
+                    async for response in session.receive():
+                        if not response:
+                            break
+
+                        response_data = response.data
+                        if response.server_content.interrupted is True:
+                            self.logger.info("Turn interrupted")
+                            playback.flush()
+                            break
+                        elif response_data is not None:
+                            playback.feed(response_data)
+
+                            if self.voice_conn.is_paused():
+                                self.voice_conn.resume()
+                            elif not self.voice_conn.is_playing():
+                                self.voice_conn.play(playback, application="voip", signal_type="voice")
+                        elif response.go_away is not None:
+                            await self.session.send_realtime_input(text=f"System: Time left in this session is {response.go_away.time_left}")
+                        else:
+                            self.logger.debug("Gemini response", response)
+
+                    self.logger.info("Turn ended")
+            finally:
+                await uplink.close()
 
         await self.voice_conn.disconnect()
 
+    def _pause_if_idle(self, playback: GeminiAudioSource):
+        # Runs on the event loop like feed(), so audio can't arrive between the check and the pause
+        if self.voice_conn.is_playing() and playback.is_idle():
+            self.voice_conn.pause()
+
     async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
         if self.session is not None:
             if before.channel is None and after.channel == self.channel:
@@ -123,42 +138,24 @@ class GeminiLiveConnection:
                 await self.voice_conn.disconnect()
                 await self.session.close()
 
-class _GeminiLivePipe(io.BytesIO):
-    def __init__(self, session: live.AsyncSession, loop: asyncio.AbstractEventLoop):
-        super().__init__()
-        self.session = session
-        self.loop = loop
-        self.logger = logging.getLogger(self.__class__.__name__)
-
-    def write(self, b: bytes):
-        if b:
-            async def send():
-                await self.session.send_realtime_input(audio=types.Blob(
-                    data=b, mime_type="audio/pcm;rate=16000"
-                ))
-
-            asyncio.run_coroutine_threadsafe(send(), self.loop)
-
-class _GeminiFFmpegSink(voice_recv.FFmpegSink):
-    active_speaker = None
+class _GeminiVoiceSink(voice_recv.AudioSink):
+    """Feeds voice decoded by voice_recv into a VoiceMixer"""
 
-    def __init__(self, session: live.AsyncSession, loop: asyncio.AbstractEventLoop):
-        super().__init__(buffer=_GeminiLivePipe(session, loop), options=f"-f s16le -ar 16000 -ac 1 -fflags flush_packets")
+    def __init__(self, mixer: VoiceMixer):
+        super().__init__()
+        self.mixer = mixer
 
-        self.session = session
-        self.loop = loop
-        self.logger = logging.getLogger(self.__class__.__name__)
+    def wants_opus(self) -> bool:
+        return False
 
     def write(self, user: Optional[discord.User], data: voice_recv.VoiceData):
-        if self.active_speaker is None:
-            self.active_speaker = user
-
-        if self.active_speaker != user:
-            return
-
-        super().write(user, data)
+        # Packets arriving before Discord says whose SSRC it is can't be stopped by on_voice_member_speaking_stop
+        if user is not None and data.pcm:
+            self.mixer.write(user.id, data.pcm)
 
     @voice_recv.AudioSink.listener()
     def on_voice_member_speaking_stop(self, member: discord.Member):
-        if member == self.active_speaker:
-            self.active_speaker = None
+        self.mixer.stop(member.id)
+
+    def cleanup(self):
+        pass
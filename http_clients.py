@@ -0,0 +1,73 @@
+import asyncio
+import importlib.util
+import logging
+from typing import Optional
+
+import httpx
+
+DEFAULT_CONNECT_TIMEOUT_SECONDS = 10
+# Models can think for a while before streaming anything
+DEFAULT_READ_TIMEOUT_SECONDS = 300
+DEFAULT_MAX_CONNECTIONS = 100
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 20
+DEFAULT_KEEPALIVE_EXPIRY_SECONDS = 120
+PREWARM_TIMEOUT_SECONDS = 10
+
+CLIENT_OPTIONS = ("http2", "connect_timeout", "read_timeout", "max_connections", "max_keepalive_connections", "keepalive_expiry")
+
+# httpx only speaks HTTP/2 with the h2 package installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class HTTPClients:
+    """
+    Shared httpx clients, one connection pool per purpose: `cdn` for Discord attachments and one per provider,
+    so attachment downloads and model streams don't compete for connections
+    """
+
+    def __init__(self, options: Optional[dict] = None):
+        options = options or {}
+        self.defaults = {key: options[key] for key in CLIENT_OPTIONS if key in options}
+        self.pools: dict[str, dict] = options.get("pools") or {}
+        self.clients: dict[str, httpx.AsyncClient] = {}
+
+        if options.get("http2", True) and not HTTP2_AVAILABLE:
+            logging.info("h2 is not installed, using HTTP/1.1")
+
+    def get(self, purpose: str) -> httpx.AsyncClient:
+        if (client := self.clients.get(purpose)) is None:
+            client = self.clients[purpose] = self._create({**self.defaults, **(self.pools.get(purpose) or {})})
+        return client
+
+    @staticmethod
+    def _create(options: dict) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            http2=options.get("http2", True) and HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(options.get("read_timeout", DEFAULT_READ_TIMEOUT_SECONDS), connect=options.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT_SECONDS)),
+            limits=httpx.Limits(
+                max_connections=options.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+                max_keepalive_connections=options.get("max_keepalive_connections", DEFAULT_MAX_KEEPALIVE_CONNECTIONS),
+                keepalive_expiry=options.get("keepalive_expiry", DEFAULT_KEEPALIVE_EXPIRY_SECONDS),
+            ),
+        )
+
+    async def prewarm(self, base_urls: dict[str, str]):
+        """Open a connection to each provider so the first request doesn't pay for DNS and the TLS handshake"""
+        async def warm(purpose: str, base_url: str):
+            try:
+                # Any response will do, the connection stays in the pool
+                await self.get(purpose).head(base_url, timeout=PREWARM_TIMEOUT_SECONDS)
+            except httpx.HTTPError as e:
+                logging.info(f"Couldn't prewarm connection to {purpose} ({base_url}): {e!r}")
+
+        await asyncio.gather(*(warm(purpose, base_url) for purpose, base_url in base_urls.items()))
+
+    def connections(self) -> list[tuple[dict, int]]:
+        """Open connections per pool. httpx doesn't expose this, it's read from httpcore's pool"""
+        return [
+            ({"pool": purpose}, len(getattr(getattr(client._transport, "_pool", None), "connections", ())))
+            for purpose, client in self.clients.items()
+        ]
+
+    async def aclose(self):
+        await asyncio.gather(*(client.aclose() for client in self.clients.values()))
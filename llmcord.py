@@ -1,29 +1,46 @@
 import asyncio
+import contextlib
 import dataclasses
 import logging
+import os
 import time
 import typing
-from dataclasses import field
 from datetime import datetime
-from itertools import zip_longest
 from typing import Optional
 
+# Before the slow imports below, for the startup time logged in on_ready
+STARTED_AT = time.perf_counter()
+
 import discord
-import httpx
 from discord.app_commands import Choice
 from discord.ext import commands
-from pydantic_ai import Agent
+from pydantic_ai import Agent, RunContext
 from pydantic_ai.messages import ModelMessage, ModelRequest, ImageUrl, AudioUrl, VideoUrl, DocumentUrl, \
-    ModelResponse, UserPromptPart, TextPart, UserContent, PartDeltaEvent, PartStartEvent, BinaryContent, \
-    ModelRequestPart, ModelResponsePart, ToolCallPart
+    ModelResponse, UserPromptPart, TextPart, UserContent, PartDeltaEvent, PartStartEvent
 from pydantic_ai.models.openai import OpenAIModel
 from pydantic_ai.providers.openai import OpenAIProvider
 from pydantic_ai.settings import ModelSettings
 from pydantic_ai.toolsets import AbstractToolset
-from pydantic_ai.mcp import MCPServerStdio, MCPServerStreamableHTTP
 
-import gemini_live
-from config import get_config, config
+from active_runs import RunRegistry
+from admission import AdmissionRejected, AdmissionScheduler
+from attachments import PREPROCESSING_AVAILABLE, AttachmentStore, ImageOptions
+from chain_resolver import ChainResolver
+from config import ConfigSnapshot, current_config, reload_config, watch_config
+from edit_scheduler import EditScheduler
+from failover import FailoverRunner, ProviderHealth, provider_of
+from http_clients import HTTPClients
+import metrics
+from mcp_pool import MCPPool
+from metrics import CHAIN_NODES, DISCORD_FETCHES, STAGE_SECONDS, TIME_TO_FIRST_TOKEN_SECONDS, TOKENS_PER_SECOND
+from msg_cache import MsgNodeCache
+from msg_node import MsgNode
+from node_store import NodeStore
+from prompt_cache import CacheControlOpenAIModel, static_system_prompt, volatile_context
+from shared_state import create_shared_state
+from stream_renderer import StreamRenderer
+from summarizer import DEFAULT_SUMMARY_KEEP_RECENT, DEFAULT_SUMMARY_THRESHOLD, SUMMARY_INSTRUCTIONS, render_transcript, summary_message
+from token_budget import IMAGE_TOKENS, MESSAGE_OVERHEAD_TOKENS, estimate_text_tokens
 
 logging.basicConfig(
     level=logging.INFO,
@@ -37,54 +54,59 @@ EMBED_COLOR_COMPLETE = discord.Color.dark_green()
 EMBED_COLOR_INCOMPLETE = discord.Color.orange()
 
 STREAMING_INDICATOR = " ⚪"
-EDIT_DELAY_SECONDS = 1
 
 MAX_MESSAGE_NODES = 500
+MAX_MESSAGE_NODE_BYTES = 256 * 1024 * 1024
 
-curr_model = next(iter(config["models"]))
-max_text = config.get("max_text", 100000)
-max_messages = config.get("max_messages", 25)
+# Current model selected with /model, shared by all workers when sharding
+shared_state = create_shared_state(current_config().get("sharding"))
 
-msg_nodes: 'dict[Any, MsgNode]' = {}
-last_task_time = 0
+msg_nodes = MsgNodeCache(MAX_MESSAGE_NODES, MAX_MESSAGE_NODE_BYTES)
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.voice_states = True
-activity = discord.CustomActivity(name=(config["status_message"] or "github.com/jakobdylanc/llmcord")[:128])
-discord_bot = commands.Bot(intents=intents, activity=activity, command_prefix=None)
-
-def parse_mcp_option(name: str, option: dict):
-    if "url" in option:
-        return MCPServerStreamableHTTP(option["url"], tool_prefix=name, max_retries=option.get("max_retries", 5))
-    else:
-        option.setdefault("tool_prefix", name)
-        return MCPServerStdio(**option)
-
-toolsets: list[AbstractToolset] = [
-    parse_mcp_option(name, mcp)
-    for name, mcp in config.get("mcpServers", {}).items()
-]
-
-httpx_client = httpx.AsyncClient()
-
-
-@dataclasses.dataclass
-class MsgNode:
-    msg: Optional[list[ModelMessage]] = None
-
-    fetch_parent_failed: bool = False
-    parent_msg: Optional[discord.Message] = None
-    override_system_prompt: bool = False
-
-    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
-
-
-async def discord_attachment_to_fileurl(att: discord.Attachment) -> BinaryContent | ImageUrl | AudioUrl | VideoUrl | DocumentUrl:
+activity = discord.CustomActivity(name=(current_config().get("status_message") or "github.com/jakobdylanc/llmcord")[:128])
+if sharding := current_config().get("sharding"):
+    # Each worker process runs some of the shards, LLMCORD_SHARD_IDS overrides shard_ids so workers can share a config file
+    shard_ids = [int(shard_id) for shard_id in os.environ["LLMCORD_SHARD_IDS"].split(",")] if os.environ.get("LLMCORD_SHARD_IDS") else sharding.get("shard_ids")
+    discord_bot = commands.AutoShardedBot(intents=intents, activity=activity, command_prefix=None, shard_count=sharding.get("shard_count"), shard_ids=shard_ids)
+else:
+    discord_bot = commands.Bot(intents=intents, activity=activity, command_prefix=None)
+edit_scheduler = EditScheduler(discord_bot)
+admission = AdmissionScheduler()
+active_runs = RunRegistry()
+provider_health = ProviderHealth()
+
+metrics.registry.gauge("llmcord_msg_nodes", "Cached message nodes", lambda: msg_nodes.stats()["nodes"])
+metrics.registry.gauge("llmcord_msg_nodes_bytes", "Estimated memory used by cached message nodes", lambda: msg_nodes.stats()["bytes"])
+metrics.registry.gauge("llmcord_runs", "Responses being generated (active) or waiting for a slot (queued)", lambda: [({"state": state}, admission.stats()[state]) for state in ("active", "queued")])
+metrics.registry.gauge("llmcord_provider_circuit_open", "Whether a provider is being skipped after failures", lambda: [({"provider": provider}, stats["open"]) for provider, stats in provider_health.stats().items()])
+
+mcp_pool = MCPPool.from_config(current_config().get("mcpServers") or {})
+toolsets: list[AbstractToolset] = list(mcp_pool.servers)
+
+http_clients = HTTPClients(current_config().get("http"))
+# Created in main(), HTTP clients aren't built on import (an HTTP/2 client imports h2)
+attachment_store: AttachmentStore
+metrics.registry.gauge("llmcord_http_connections", "Open HTTP connections per pool", http_clients.connections)
+
+
+async def get_msg_node(msg_id: int) -> MsgNode:
+    """Get a node from the cache, falling back to the persistent store"""
+    if (node := msg_nodes.get(msg_id)) is not None:
+        CHAIN_NODES.inc(source="cache")
+        return node
+
+    stored = await msg_nodes.store.get(msg_id) if msg_nodes.store is not None else None
+    CHAIN_NODES.inc(source="store" if stored else "discord")
+    return msg_nodes.setdefault(msg_id, MsgNode(**stored) if stored else MsgNode())
+
+
+def discord_attachment_to_fileurl(att: discord.Attachment) -> ImageUrl | AudioUrl | VideoUrl | DocumentUrl:
     if att.content_type.startswith("image"):
-        # Force fetch
-        return BinaryContent(data=(await httpx_client.get(att.url)).content, media_type=att.content_type)
-        # return ImageUrl(att.url, media_type=att.content_type)
+        # Downloaded lazily into the attachment store, see convert_attachments
+        return ImageUrl(att.url, media_type=att.content_type)
     elif att.content_type.startswith("audio"):
         return AudioUrl(att.url, media_type=att.content_type)
     # Not supported by OpenAI
@@ -94,12 +116,37 @@ async def discord_attachment_to_fileurl(att: discord.Attachment) -> BinaryConten
         return DocumentUrl(att.url, media_type=att.content_type)
 
 
+async def convert_attachments(attachments: list[discord.Attachment], max_images: int) -> list[UserContent]:
+    """Convert the attachments the model can use, only downloading images that will be sent"""
+    selected = []
+    for att in attachments:
+        if len(selected) >= max_images:
+            # user_warnings.add(f"⚠️ Max {max_images} image{'' if max_images == 1 else 's'} per message" if max_images > 0 else "⚠️ Can't see images")
+            break
+
+        file_url = discord_attachment_to_fileurl(att)
+        if isinstance(file_url, DocumentUrl):
+            # user_warnings.add("⚠️ Unsupported attachments")
+            continue
+        selected.append((att, file_url))
+
+    async def convert(att: discord.Attachment, file_url: UserContent) -> Optional[UserContent]:
+        if isinstance(file_url, ImageUrl):
+            return await attachment_store.handle(att)
+        return file_url
+
+    converted = await asyncio.gather(*[convert(att, file_url) for att, file_url in selected])
+    return [content for content in converted if content is not None]
+
+
 async def discord_msg_to_modelmessage(msg: discord.Message, max_images: int) -> ModelMessage:
     if msg.author == discord_bot.user:
         out = ModelResponse(parts=[])
     else:
         out = ModelRequest(parts=[])
 
+    max_text = current_config().get("max_text", 100000)
+
     cleaned_content = msg.content.removeprefix(discord_bot.user.mention).lstrip()
     text = "\n".join(
         ([cleaned_content] if cleaned_content else [])
@@ -112,19 +159,7 @@ async def discord_msg_to_modelmessage(msg: discord.Message, max_images: int) ->
         # user_warnings.add(f"⚠️ Max {max_text:,} characters per message")
 
     if msg.author != discord_bot.user:
-        content: list[UserContent] = [text]
-
-        attachments = await asyncio.gather(*[discord_attachment_to_fileurl(att) for att in msg.attachments])
-        for att in attachments:
-            if not isinstance(att, DocumentUrl):
-                content.append(att)
-            else:
-                # user_warnings.add("⚠️ Unsupported attachments")
-                pass
-
-        if len(content) > max_images + 1:
-            # user_warnings.add(f"⚠️ Max {max_images} image{'' if max_images == 1 else 's'} per message" if max_images > 0 else "⚠️ Can't see images")
-            content = content[:max_images+1]
+        content: list[UserContent] = [text, *await convert_attachments(msg.attachments, max_images)]
 
         # curr_node.user_id = curr_msg.author.id if curr_node.role == "user" else None
         out.parts.append(UserPromptPart(content=content))
@@ -133,15 +168,28 @@ async def discord_msg_to_modelmessage(msg: discord.Message, max_images: int) ->
 
     return out
 
+
+def estimate_discord_msg_tokens(msg: discord.Message, max_images: int) -> int:
+    """Tokens a message will take once converted, used to stop walking the chain before its conversion is done"""
+    text_tokens = estimate_text_tokens(msg.content) + sum(estimate_text_tokens(embed.description or "") for embed in msg.embeds)
+    images = sum(1 for att in msg.attachments if (att.content_type or "").startswith("image"))
+    return MESSAGE_OVERHEAD_TOKENS + text_tokens + min(images, max_images) * IMAGE_TOKENS
+
+def current_model(config: ConfigSnapshot) -> str:
+    """The model selected with /model, or the first one if none was or it was removed from the config"""
+    model = shared_state.get("model")
+    return model if model in config["models"] else next(iter(config["models"]))
+
+
 @discord_bot.tree.command(name="model", description="View or switch the current model")
 async def model_command(interaction: discord.Interaction, model: str) -> None:
-    global curr_model
+    curr_model = current_model(current_config())
 
     if model == curr_model:
         output = f"Current model: `{curr_model}`"
     else:
-        if user_is_admin := interaction.user.id in config["permissions"]["users"]["admin_ids"]:
-            curr_model = model
+        if interaction.user.id in current_config().admin_ids:
+            await shared_state.set("model", model)
             output = f"Model switched to: `{model}`"
             logging.info(output)
         else:
@@ -152,21 +200,59 @@ async def model_command(interaction: discord.Interaction, model: str) -> None:
 
 @model_command.autocomplete("model")
 async def model_autocomplete(interaction: discord.Interaction, curr_str: str) -> list[Choice[str]]:
-    choices = [Choice(name=f"○ {model}", value=model) for model in config["models"] if model != curr_model and curr_str.lower() in model.lower()][:24]
+    curr_model = current_model(current_config())
+    choices = [Choice(name=f"○ {model}", value=model) for model in current_config()["models"] if model != curr_model and curr_str.lower() in model.lower()][:24]
     choices += [Choice(name=f"◉ {curr_model} (current)", value=curr_model)] if curr_str.lower() in curr_model.lower() else []
 
     return choices
 
 
+@discord_bot.tree.command(name="reload", description="Reload config.yaml")
+async def reload_command(interaction: discord.Interaction) -> None:
+    if interaction.user.id not in current_config().admin_ids:
+        output = "You don't have permission to reload the config."
+    elif await asyncio.to_thread(reload_config, force=True):
+        output = f"Config reloaded (version {current_config().version})"
+    else:
+        output = "Config is invalid, keeping the previous version. Check the logs for details."
+
+    await interaction.response.send_message(output, ephemeral=True)
+
+
 @discord_bot.event
 async def on_ready() -> None:
-    if client_id := config["client_id"]:
+    if client_id := current_config().get("client_id"):
         logging.info(f"\n\nBOT INVITE URL:\nhttps://discord.com/oauth2/authorize?client_id={client_id}&permissions=412317273088&scope=bot\n")
 
-    await discord_bot.tree.sync()
+    # Commands are global, with several workers only the one running shard 0 syncs them
+    if 0 in (getattr(discord_bot, "shard_ids", None) or [0]):
+        await discord_bot.tree.sync()
+    logging.info(f"Ready {time.perf_counter() - STARTED_AT:.2f}s after startup")
+
+    config = current_config()
+    if (config.get("http") or {}).get("prewarm", False):
+        await http_clients.prewarm({name: provider["base_url"] for name, provider in config["providers"].items()})
+
+@dataclasses.dataclass
+class RunDeps:
+    """Per-message data for a run of a cached Agent"""
+    author: discord.User | discord.Member
+    override_system_prompt: bool = False
+
+
+agents: dict[tuple[str, int], Agent[RunDeps, str]] = {}
+
+
+def get_agent(provider_slash_model: str, config: ConfigSnapshot) -> Agent[RunDeps, str]:
+    key = (provider_slash_model, config.version)
+    if (agent := agents.get(key)) is None:
+        for stale_key in [k for k in agents if k[1] != config.version]:
+            del agents[stale_key]
+        agent = agents[key] = build_agent(provider_slash_model, config)
 
-def get_agent(new_msg: discord.Message) -> Agent:
-    provider_slash_model = curr_model
+    return agent
+
+def build_model(provider_slash_model: str, config: ConfigSnapshot) -> OpenAIModel:
     provider, model = provider_slash_model.removesuffix(":vision").split("/", 1)
 
     provider_config = config["providers"][provider]
@@ -178,49 +264,151 @@ def get_agent(new_msg: discord.Message) -> Agent:
     extra_body = provider_config.get("extra_body", None) or {}
 
     model_parameters = config["models"].get(provider_slash_model, None) or {}
-    model_parameters["extra_headers"] = extra_headers
-    model_parameters["extra_body"] = extra_body
+    model_settings = ModelSettings(**{**model_parameters, "extra_headers": extra_headers, "extra_body": extra_body})
+
+    prompt_cache = model_parameters.get("prompt_cache")
+    model_class = CacheControlOpenAIModel if isinstance(prompt_cache, dict) and prompt_cache.get("cache_control") else OpenAIModel
+
+    provider = OpenAIProvider(base_url=base_url, api_key=api_key, http_client=http_clients.get(provider))
+    return model_class(model_name=model, provider=provider, settings=model_settings)
 
+
+def build_agent(provider_slash_model: str, config: ConfigSnapshot) -> Agent[RunDeps, str]:
+    model_parameters = config["models"].get(provider_slash_model, None) or {}
+    model = build_model(provider_slash_model, config)
     agent_kwargs = {}
 
-    provider = OpenAIProvider(base_url=base_url, api_key=api_key, http_client=httpx_client)
-    model = OpenAIModel(model_name=model, provider=provider, settings=ModelSettings(**model_parameters))
+    system_prompt_template = config.get("system_prompt")
+    accept_usernames = any(x in provider_slash_model.lower() for x in PROVIDERS_SUPPORTING_USERNAMES)
 
-    system_prompt = None
-    if "system_prompt" in config:
-        now = datetime.now().astimezone()
+    # Keep the system prompt identical across requests so providers can cache it, volatile tags are sent with the latest message
+    prompt_cache = bool(model_parameters.get("prompt_cache"))
+    if prompt_cache and system_prompt_template:
+        system_prompt_template = static_system_prompt(system_prompt_template)
 
-        accept_usernames = any(x in provider_slash_model.lower() for x in PROVIDERS_SUPPORTING_USERNAMES)
+    def system_prompt(ctx: RunContext[RunDeps]) -> str:
+        if not system_prompt_template or ctx.deps.override_system_prompt:
+            return ""
+
+        now = datetime.now().astimezone()
         system_prompt = [
-            config["system_prompt"]
+            system_prompt_template
                 .replace("{id}", discord_bot.user.mention)
-                .replace("{user_id}", new_msg.author.mention)
+                .replace("{user_id}", ctx.deps.author.mention)
                 .replace("{date}", now.strftime("%B %d %Y"))
                 .replace("{time}", now.strftime("%H:%M:%S %Z%z"))
                 .strip()
-         ]
+        ]
         if accept_usernames:
             system_prompt.append("User's names are their Discord IDs and should be typed as '<@ID>'")
 
+        return "\n".join(system_prompt)
+
     support_tool_use = model_parameters.get("tools", False)
     if support_tool_use:
-        def get_user():
+        def get_user(ctx: RunContext[RunDeps]) -> str:
             """Get the user information of the last message"""
-            return f"Last message's author name: {new_msg.author.name}\nWhen mentioning this user's full name, ALWAYS use the mention tag {new_msg.author.mention} (with <>) instead of their name\nSubsequent messages may have different names"
+            author = ctx.deps.author
+            return f"Last message's author name: {author.name}\nWhen mentioning this user's full name, ALWAYS use the mention tag {author.mention} (with <>) instead of their name\nSubsequent messages may have different names"
         agent_kwargs['tools'] = [get_user]
         agent_kwargs['toolsets'] = toolsets
 
     agent = Agent(
         model=model,
         instructions=system_prompt,
+        deps_type=RunDeps,
         output_type=str,
         retries=model_parameters.get("retries", 5),
         **agent_kwargs,
     )
     agent.image_support = model_parameters.get("image", False) or any(x in agent.model.model_name for x in VISION_MODEL_TAGS)
+    agent.image_options = ImageOptions.from_config(model_parameters.get("image_preprocess"))
+    agent.prompt_cache = prompt_cache
 
     return agent
 
+
+summary_tasks: dict[int, asyncio.Task] = {}
+
+
+async def summarize_chain(node_id: int, node: MsgNode, previous_summary: Optional[str], messages: list[ModelMessage], config: ConfigSnapshot):
+    agent = Agent(model=build_model(config["summarization"]["model"], config), instructions=SUMMARY_INSTRUCTIONS, output_type=str)
+    try:
+        result = await agent.run(render_transcript(previous_summary, messages))
+    except Exception:
+        logging.exception("Error summarizing conversation")
+        return
+
+    node.summary, node.tokens = result.output, None
+    if node_id in msg_nodes:
+        msg_nodes.commit(node_id)
+    logging.info(f"Summarized {len(messages)} messages into message {node_id} ({node.token_count()} tokens)")
+
+
+def schedule_summary(chain_nodes: list[tuple[int, MsgNode]], config: ConfigSnapshot):
+    """
+    Once a chain passes the threshold, summarize all but its most recent nodes in the background.
+    The summary includes the previous one, so each part of a conversation is summarized once
+    """
+    options = config.get("summarization")
+    if not options:
+        return
+
+    # Counted in messages like max_messages, a node holds one message or a whole bot turn
+    keep_recent = max(options.get("keep_recent", DEFAULT_SUMMARY_KEEP_RECENT), 1)
+    previous_summary = chain_nodes[-1][1].summary if len(chain_nodes) > 1 else None
+    raw_nodes = chain_nodes[:-1] if previous_summary is not None else chain_nodes
+    if sum(len(node.msg) for _, node in raw_nodes) <= max(options.get("threshold", DEFAULT_SUMMARY_THRESHOLD), keep_recent):
+        return
+
+    # The summary goes on the newest node that isn't kept
+    split, kept = 0, 0
+    while kept < keep_recent:
+        kept += len(raw_nodes[split][1].msg)
+        split += 1
+    if split >= len(raw_nodes):
+        return
+    node_id, node = raw_nodes[split]
+    if node.summary is not None or node_id in summary_tasks:
+        return
+
+    # Node messages are newest first
+    messages = [message for _, tail_node in raw_nodes[split:] for message in tail_node.msg][::-1]
+    summary_tasks[node_id] = asyncio.create_task(summarize_chain(node_id, node, previous_summary, messages, config))
+    summary_tasks[node_id].add_done_callback(lambda _: summary_tasks.pop(node_id, None))
+
+class StopView(discord.ui.View):
+    """Stop button on a response while it streams, for the user who asked and admins"""
+
+    def __init__(self, msg_id: int, author_id: int):
+        super().__init__(timeout=None)
+        self.msg_id = msg_id
+        self.author_id = author_id
+
+    @discord.ui.button(label="Stop", emoji="⏹️", style=discord.ButtonStyle.secondary)
+    async def stop_response(self, interaction: discord.Interaction, button: discord.ui.Button) -> None:
+        if interaction.user.id != self.author_id and interaction.user.id not in current_config().admin_ids:
+            await interaction.response.send_message("Only the user who asked can stop this response", ephemeral=True)
+            return
+        await interaction.response.defer()
+        active_runs.stop(self.msg_id, "Stopped")
+
+
+@discord_bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent) -> None:
+    active_runs.stop(payload.message_id, "Stopped, the message was deleted")
+
+
+@discord_bot.event
+async def on_message_edit(before: discord.Message, after: discord.Message) -> None:
+    # Embeds being added to a message also count as edits
+    if before.content == after.content:
+        return
+    if (run := active_runs.stop(after.id, "Stopped, the message was edited")) is not None and current_config().get("regenerate_on_edit", False):
+        await asyncio.gather(run.task, return_exceptions=True)
+        await on_message(after)
+
+
 @discord_bot.event
 async def on_message(new_msg: discord.Message) -> None:
     is_dm = new_msg.channel.type == discord.ChannelType.private
@@ -231,30 +419,26 @@ async def on_message(new_msg: discord.Message) -> None:
     role_ids = set(role.id for role in getattr(new_msg.author, "roles", ()))
     channel_ids = set(filter(None, (new_msg.channel.id, getattr(new_msg.channel, "parent_id", None), getattr(new_msg.channel, "category_id", None))))
 
-    config = await asyncio.to_thread(get_config)
+    with STAGE_SECONDS.time(stage="config"):
+        config = current_config()
 
     allow_dms = config.get("allow_dms", True)
 
-    permissions = config["permissions"]
-
-    user_is_admin = new_msg.author.id in permissions["users"]["admin_ids"]
+    user_is_admin = new_msg.author.id in config.admin_ids
 
-    (allowed_user_ids, blocked_user_ids), (allowed_role_ids, blocked_role_ids), (allowed_channel_ids, blocked_channel_ids) = (
-        (perm["allowed_ids"], perm["blocked_ids"]) for perm in (permissions["users"], permissions["roles"], permissions["channels"])
-    )
+    allow_all_users = not config.allowed_user_ids if is_dm else not config.allowed_user_ids and not config.allowed_role_ids
+    is_good_user = user_is_admin or allow_all_users or new_msg.author.id in config.allowed_user_ids or not config.allowed_role_ids.isdisjoint(role_ids)
+    is_bad_user = not is_good_user or new_msg.author.id in config.blocked_user_ids or not config.blocked_role_ids.isdisjoint(role_ids)
 
-    allow_all_users = not allowed_user_ids if is_dm else not allowed_user_ids and not allowed_role_ids
-    is_good_user = user_is_admin or allow_all_users or new_msg.author.id in allowed_user_ids or any(id in allowed_role_ids for id in role_ids)
-    is_bad_user = not is_good_user or new_msg.author.id in blocked_user_ids or any(id in blocked_role_ids for id in role_ids)
-
-    allow_all_channels = not allowed_channel_ids
-    is_good_channel = user_is_admin or allow_dms if is_dm else allow_all_channels or any(id in allowed_channel_ids for id in channel_ids)
-    is_bad_channel = not is_good_channel or any(id in blocked_channel_ids for id in channel_ids)
+    allow_all_channels = not config.allowed_channel_ids
+    is_good_channel = user_is_admin or allow_dms if is_dm else allow_all_channels or not config.allowed_channel_ids.isdisjoint(channel_ids)
+    is_bad_channel = not is_good_channel or not config.blocked_channel_ids.isdisjoint(channel_ids)
 
     if is_bad_user or is_bad_channel:
         return
 
-    agent = get_agent(new_msg)
+    provider_slash_model = current_model(config)
+    agent = get_agent(provider_slash_model, config)
 
     accept_images = typing.cast(typing.Any, agent).image_support
     max_images = config.get("max_images", 5) if accept_images else 0
@@ -262,170 +446,355 @@ async def on_message(new_msg: discord.Message) -> None:
     # Build message chain and set user warnings
     messages: list[ModelMessage] = []
     user_warnings = set()
-    curr_msg = new_msg
+    curr_msg_id, curr_channel_id, curr_msg = new_msg.id, new_msg.channel.id, new_msg
     override_system_prompt = False
 
-    while curr_msg is not None and len(messages) < max_messages:
-        curr_node = msg_nodes.setdefault(curr_msg.id, MsgNode())
-
-        async with curr_node.lock:
-            if curr_node.msg is None:
-                curr_node.msg = [await discord_msg_to_modelmessage(curr_msg, max_images)]
+    max_messages = config.get("max_messages", 25)
+    # Room left for the chain once the system prompt is in, unlimited if the model has no max_input_tokens
+    token_budget = None
+    if max_input_tokens := (config["models"].get(provider_slash_model) or {}).get("max_input_tokens"):
+        token_budget = max_input_tokens - estimate_text_tokens(config.get("system_prompt") or "")
+    chain_tokens = 0
+
+    chain_resolver = ChainResolver(discord_bot, max_messages)
+    # Nodes being built keep their lock until their attachments are converted, which overlaps with walking up the chain
+    chain_nodes: list[tuple[int, MsgNode]] = []
+    pending_nodes: list[tuple[int, MsgNode, asyncio.Task]] = []
+    chain_length = 0
+    # Past max_messages the walk goes on through built nodes to the nearest summary, which covers everything before it.
+    # Without one the chain is cut back to max_messages
+    find_summary = bool(config.get("summarization"))
+    within_limit: Optional[int] = None
+
+    chain_started_at = time.perf_counter()
+    async with contextlib.AsyncExitStack() as node_locks:
+        while curr_msg_id is not None and (token_budget is None or chain_tokens < token_budget):
+            if chain_length >= max_messages and within_limit is None:
+                if not find_summary:
+                    break
+                within_limit = len(chain_nodes)
+
+            curr_node = await get_msg_node(curr_msg_id)
+            if within_limit is not None and (curr_node.msg is None or curr_node.lock.locked()):
+                break
+
+            await curr_node.lock.acquire()
+            if curr_node.msg is not None:
+                # Already built, no need to hold it
+                curr_node.lock.release()
+                chain_length += len(curr_node.msg)
+                chain_tokens += curr_node.token_count()
+            else:
+                node_locks.callback(curr_node.lock.release)
+                if curr_msg is None:
+                    # Parent known from the store but neither it nor its node is cached
+                    try:
+                        curr_msg = await chain_resolver.fetch_by_channel_id(curr_channel_id, curr_msg_id)
+                    except (discord.NotFound, discord.HTTPException):
+                        logging.exception("Error fetching next message in the chain")
+                        break
+
+                pending_nodes.append((curr_msg_id, curr_node, asyncio.create_task(discord_msg_to_modelmessage(curr_msg, max_images))))
                 # TODO: Warnings
                 try:
-                    if (
-                        curr_msg.reference is None
-                        and discord_bot.user.mention not in curr_msg.content
-                        and (prev_msg_in_channel := ([m async for m in curr_msg.channel.history(before=curr_msg, limit=1)] or [None])[0])
-                        and prev_msg_in_channel.type in (discord.MessageType.default, discord.MessageType.reply)
-                        and prev_msg_in_channel.author == (discord_bot.user if curr_msg.channel.type == discord.ChannelType.private else curr_msg.author)
-                    ):
-                        curr_node.parent_msg = prev_msg_in_channel
-                    else:
-                        is_public_thread = curr_msg.channel.type == discord.ChannelType.public_thread
-                        parent_is_thread_start = is_public_thread and curr_msg.reference == None and curr_msg.channel.parent.type == discord.ChannelType.text
-
-                        if parent_msg_id := curr_msg.channel.id if parent_is_thread_start else getattr(curr_msg.reference, "message_id", None):
-                            if parent_is_thread_start:
-                                curr_node.parent_msg = curr_msg.channel.starter_message or await curr_msg.channel.parent.fetch_message(parent_msg_id)
-                            else:
-                                curr_node.parent_msg = curr_msg.reference.cached_message or await curr_msg.channel.fetch_message(parent_msg_id)
-
+                    if parent_msg := await chain_resolver.parent(curr_msg):
+                        curr_node.set_parent(parent_msg)
                 except (discord.NotFound, discord.HTTPException):
                     logging.exception("Error fetching next message in the chain")
                     curr_node.fetch_parent_failed = True
 
-            override_system_prompt = override_system_prompt or curr_node.override_system_prompt
-            messages.extend(curr_node.msg)
-            curr_msg = curr_node.parent_msg
+                chain_length += 1
+                chain_tokens += estimate_discord_msg_tokens(curr_msg, max_images)
+
+            chain_nodes.append((curr_msg_id, curr_node))
+            if curr_node.summary is not None and len(chain_nodes) > 1:
+                # Covers everything before it
+                within_limit = None
+                break
+            curr_msg_id, curr_channel_id, curr_msg = curr_node.parent_msg_id, curr_node.parent_channel_id, curr_node.parent_msg
+
+        if within_limit is not None:
+            chain_nodes = chain_nodes[:within_limit]
+
+        try:
+            converted = await asyncio.gather(*(convert_task for _, _, convert_task in pending_nodes))
+        except BaseException:
+            for _, _, convert_task in pending_nodes:
+                convert_task.cancel()
+            raise
+        for (msg_id, node, _), message in zip(pending_nodes, converted):
+            node.msg = [message]
+            msg_nodes.commit(msg_id)
+
+        used_tokens = 0
+        for index, (_, node) in enumerate(chain_nodes):
+            # Estimates of pending nodes can be off, drop the oldest ones that don't fit. The newest message is always sent
+            if token_budget is not None and index > 0 and used_tokens + node.token_count() > token_budget:
+                user_warnings.add(f"⚠️ Only using last {len(messages)} message{'' if len(messages) == 1 else 's'}")
+                chain_nodes = chain_nodes[:index]
+                break
+            used_tokens += node.token_count()
+            override_system_prompt = override_system_prompt or node.override_system_prompt
+            messages.extend([summary_message(node.summary)] if node.summary is not None and index > 0 else node.msg)
+
+    # A character card's lorebook, if the chain reaches back to the card. Rebuilt when the node was evicted or came from the store
+    if card_node := next((node for _, node in reversed(chain_nodes) if node.lorebook is not None or node.card_digest is not None), None):
+        if card_node.lorebook is None and card_lorebooks is not None:
+            card_node.lorebook = await card_lorebooks(card_node.card_digest, card_node.card_user)
+        if card_node.lorebook is not None:
+            messages = card_node.lorebook.apply(messages, card_node, [node for _, node in chain_nodes])
+
+    schedule_summary(chain_nodes, config)
+
+    STAGE_SECONDS.observe(time.perf_counter() - chain_started_at, stage="chain")
+    DISCORD_FETCHES.inc(chain_resolver.history_fetches, kind="history")
+    DISCORD_FETCHES.inc(chain_resolver.point_fetches, kind="message")
 
     logging.info(f"Message received (user ID: {new_msg.author.id}, attachments: {len(new_msg.attachments)}, conversation length: {len(messages)}):\n{new_msg.content}")
 
     use_plain_responses = config.get("use_plain_responses", False)
     max_message_length = 2000 if use_plain_responses else (4096 - len(STREAMING_INDICATOR))
 
-    edit_task = None
     response_msgs: list[discord.Message] = []
-
-    if override_system_prompt:
-        # Hack
-        agent._instructions = None
-
-    async def update_reply(message: str, incomplete=False, force_flush=False):
+    edits: list[asyncio.Future] = []
+    renderer = StreamRenderer(max_message_length)
+
+    def build_embed(index: int, incomplete: bool) -> discord.Embed:
+        is_last = index == len(renderer.pages) - 1
+        embed = discord.Embed(
+            description=renderer.pages[index] + (STREAMING_INDICATOR if incomplete and is_last else ""),
+            color=EMBED_COLOR_INCOMPLETE if incomplete else EMBED_COLOR_COMPLETE,
+        )
+        if index == 0:
+            for warning in sorted(user_warnings):
+                embed.add_field(name=warning, value="", inline=False)
+        return embed
+
+    async def update_reply(incomplete=False, force_flush=False):
         """
-        Create reply to user's message, or update existing reply (within rate limit)
+        Create reply to user's message, or schedule updates of existing replies (within rate limit)
         Also manage the split of messages when cap is hit
         """
-        nonlocal response_msgs, edit_task
-        global last_task_time
-
-        if incomplete:
-            message += STREAMING_INDICATOR
-
-        message_left = message
-        message_parts = []
-        while len(message_left) > 0:
-            message_parts.append(message_left[:max_message_length])
-            message_left = message_left[max_message_length:]
-
-        for (index, (part_message, discord_msg)) in enumerate(zip_longest(message_parts, response_msgs)):
-            embed = discord.Embed()
-            embed.description = part_message
-            if index == 0:
-                for warning in sorted(user_warnings):
-                    embed.add_field(name=warning, value="", inline=False)
-
-            embed.color = EMBED_COLOR_COMPLETE
-            if incomplete:
-                embed.color = EMBED_COLOR_INCOMPLETE
-
-            # (Some, None) = Create
-            # (Some, Some) = Update
-            # (None, Some) = Delete
-            # (None, None) = Should not happen
-            if part_message is not None and discord_msg is None: # Create
+        nonlocal edits
+
+        dirty = renderer.take_dirty()
+        priority = not incomplete or force_flush
+
+        for index in range(max(len(renderer.pages), len(response_msgs))):
+            if index >= len(response_msgs): # Create
                 reply_to_msg = new_msg if response_msgs == [] else response_msgs[-1]
-                discord_msg = await reply_to_msg.reply(embed=embed, silent=True)
+                discord_msg = await reply_to_msg.reply(embed=build_embed(index, incomplete), view=stop_view if incomplete and index == 0 else None, silent=True)
                 response_msgs.append(discord_msg)
+                renderer.dirty.discard(index)
+
+                response_node = msg_nodes[discord_msg.id] = MsgNode()
+                response_node.set_parent(new_msg)
+                await response_node.lock.acquire()
+                response_nodes.append(response_node)
+            elif index < len(renderer.pages): # Update
+                if index in dirty:
+                    # Rendered when the scheduler sends the edit, pending edits of the same message are replaced
+                    edits.append(edit_scheduler.edit(
+                        response_msgs[index],
+                        lambda index=index, incomplete=incomplete: {"embed": build_embed(index, incomplete), "view": stop_view if incomplete and index == 0 else None},
+                        priority=priority,
+                    ))
+            else: # Delete
+                await response_msgs[index].delete()
+
+        del response_msgs[len(renderer.pages):]
+        edits = [edit for edit in edits if not edit.done()]
+
+    # Skip providers whose circuit is open, unless all of them are
+    model_parameters = config["models"].get(provider_slash_model) or {}
+    candidates = [provider_slash_model, *(model_parameters.get("fallbacks") or [])]
+    candidates = [model for model in candidates if provider_health.available(provider_of(model))] or candidates
+
+    # Editing or deleting the message, or the stop button, cancels this task
+    active_run = active_runs.start(new_msg.id, new_msg.author.id)
+    admission.configure(config.get("admission"), config["providers"], config.version)
+    try:
+        with STAGE_SECONDS.time(stage="queue"):
+            ticket = await admission.acquire(new_msg.author.id, new_msg.channel.id, provider_of(candidates[0]))
+    except AdmissionRejected as e:
+        active_runs.finish(active_run)
+        logging.warning(f"Rejected message (user ID: {new_msg.author.id}): {e}")
+        await new_msg.reply("⏳ Too many requests right now, please try again in a moment.", silent=True)
+        return
+    except asyncio.CancelledError:
+        active_runs.finish(active_run)
+        if active_run.stop_reason is None:
+            raise
+        return
 
-                msg_nodes[discord_msg.id] = MsgNode(parent_msg=new_msg)
-                await msg_nodes[discord_msg.id].lock.acquire()
-            elif part_message is not None and discord_msg is not None: # Update
-                if discord_msg.content != part_message:
-                    ready_to_edit = (edit_task is None or edit_task.done()) and time.monotonic() - last_task_time >= EDIT_DELAY_SECONDS
-                    if ready_to_edit or not incomplete or force_flush:
-                        if edit_task is not None:
-                            await edit_task
-
-                        discord_msg.content = part_message
-                        edit_task = asyncio.create_task(discord_msg.edit(embed=embed))
-                        last_task_time = time.monotonic()
-            elif part_message is None and discord_msg is not None: # Delete
-                await discord_msg.delete()
-                response_msgs = [item for item in response_msgs if item.id != discord_msg.id]
-
+    stop_view = StopView(new_msg.id, new_msg.author.id)
+    # Nodes of the response messages, locked until the response is stored
+    response_nodes: list[MsgNode] = []
     try:
         async with new_msg.channel.typing():
-            async with agent:
-                async with agent.iter(messages[0].parts[0].content, message_history=messages[1:][::-1]) as run:
-                    agent_messages = []
+            # Stored with the reply instead of the materialized content, nodes keep handles rather than attachment bytes
+            stored_prompt = messages[0].parts[0].content
+            with STAGE_SECONDS.time(stage="attachments"):
+                messages = await attachment_store.materialize(messages, typing.cast(typing.Any, agent).image_options)
+
+            run_started_at = time.perf_counter()
+            first_event_at = None
+
+            async def stream_attempt(attempt_model: str, claim: typing.Callable[[], bool]):
+                nonlocal first_event_at
+                attempt_agent = get_agent(attempt_model, config)
+                prompt = messages[0].parts[0].content
+                if typing.cast(typing.Any, attempt_agent).prompt_cache:
+                    prompt = [*prompt, volatile_context(new_msg.author)]
+
+                async with attempt_agent.iter(
+                    prompt,
+                    message_history=messages[1:][::-1],
+                    deps=RunDeps(author=new_msg.author, override_system_prompt=override_system_prompt),
+                ) as run:
                     async for node in run:
                         if Agent.is_model_request_node(node):
-                            current_part = None
                             async with node.stream(run.ctx) as request_stream:
                                 async for event in request_stream:
-                                    if isinstance(event, PartStartEvent):
-                                        if current_part is not None:
-                                            agent_messages.append([current_part])
-
-                                        current_part = event.part
-                                        # We don't commit now until the next
-                                    elif isinstance(event, PartDeltaEvent):
-                                        current_part = event.delta.apply(current_part)
-
-                                    await update_reply(format_message_history(agent_messages + [[current_part]]), incomplete=True)
-
-                            if current_part is not None:
-                                agent_messages.append([current_part])
-
-                    await update_reply(format_message_history([v.parts for v in run.result.new_messages()]))
-                    new_messages = run.result.new_messages()[::-1]
+                                    # Only the attempt that streams first renders, the others are cancelled
+                                    if isinstance(event, (PartStartEvent, PartDeltaEvent)) and claim():
+                                        if first_event_at is None:
+                                            first_event_at = time.perf_counter()
+                                            TIME_TO_FIRST_TOKEN_SECONDS.observe(first_event_at - run_started_at, model=attempt_model)
+                                        renderer.on_event(event)
+                                        await update_reply(incomplete=True)
+
+                            if claim():
+                                renderer.end_part()
+                return run.result
+
+            ticket_slot_free = True
+
+            async def attempt(attempt_model: str, claim: typing.Callable[[], bool]):
+                # One attempt at a time uses the provider slot of the ticket, failover and hedge attempts are charged to their own provider
+                nonlocal ticket_slot_free
+                if ticket_slot_free and provider_of(attempt_model) == ticket.provider:
+                    ticket_slot_free = False
+                    try:
+                        return await stream_attempt(attempt_model, claim)
+                    finally:
+                        ticket_slot_free = True
+                async with admission.provider_slot(provider_of(attempt_model)):
+                    return await stream_attempt(attempt_model, claim)
+
+            result = await FailoverRunner(candidates, attempt, provider_health, hedge_after=model_parameters.get("hedge_after")).run()
+
+            # Earlier pages were last edited while incomplete
+            renderer.mark_all_dirty()
+            await update_reply()
+            await asyncio.gather(*edits)
+            new_messages = result.new_messages()
+            if new_messages and isinstance(new_messages[0], ModelRequest):
+                new_messages[0] = dataclasses.replace(new_messages[0], parts=[
+                    dataclasses.replace(part, content=stored_prompt) if isinstance(part, UserPromptPart) else part
+                    for part in new_messages[0].parts
+                ])
+            new_messages = new_messages[::-1]
+
+            STAGE_SECONDS.observe(time.perf_counter() - run_started_at, stage="response")
+            usage = result.usage()
+            if usage.response_tokens and first_event_at is not None and (streaming_seconds := time.perf_counter() - first_event_at) > 0:
+                TOKENS_PER_SECOND.observe(usage.response_tokens / streaming_seconds)
+            logging.info(f"Usage (message ID: {new_msg.id}): {usage.request_tokens} input tokens ({(usage.details or {}).get('cached_tokens', 0)} cached), {usage.response_tokens} output tokens")
 
         for response_msg in response_msgs:
             msg_nodes[response_msg.id].msg = new_messages
-            msg_nodes[response_msg.id].lock.release()
+            msg_nodes.commit(response_msg.id)
     except Exception:
         logging.exception("Error while generating response")
-        await update_reply("An error occurred while generating response")
+        renderer.replace("An error occurred while generating response")
+        await update_reply()
+    except asyncio.CancelledError:
+        if active_run.stop_reason is None:
+            raise
+        # Leaving agent.iter closed the provider streams, show what was generated so far
+        if response_msgs:
+            user_warnings.add(f"⏹️ {active_run.stop_reason}")
+            renderer.mark_all_dirty()
+            await update_reply()
+            await asyncio.gather(*edits, return_exceptions=True)
+    finally:
+        admission.release(ticket)
+        active_runs.finish(active_run)
+        stop_view.stop()
+        for response_node in response_nodes:
+            response_node.lock.release()
+
+    # Delete least recently used MsgNodes from the cache, nodes still in use are kept
+    if evicted := msg_nodes.evict():
+        logging.debug(f"Evicted {evicted} message nodes ({msg_nodes.stats()})")
+
+
+# Rebuilds a card node's lorebook from (card digest, user), set once character cards are loaded
+card_lorebooks: Optional[typing.Callable[[str, str], typing.Awaitable[typing.Any]]] = None
+
+
+async def load_plugins(config: ConfigSnapshot):
+    """Import and register optional subsystems, only when enabled. Their dependencies are slow to import"""
+    started_at = time.perf_counter()
+    loaded = []
+
+    if (config.get("voice") or {}).get("enabled"):
+        import gemini_live
 
-    # Delete oldest MsgNodes (lowest message IDs) from the cache
-    if (num_nodes := len(msg_nodes)) > MAX_MESSAGE_NODES:
-        for msg_id in sorted(msg_nodes.keys())[: num_nodes - MAX_MESSAGE_NODES]:
-            async with msg_nodes.setdefault(msg_id, MsgNode()).lock:
-                msg_nodes.pop(msg_id, None)
+        discord_bot.tree.add_command(gemini_live.live_command)
+        loaded.append("voice")
+    if config.get("enable_character_card", False):
+        from character_card.cog import CharacterCardCog
+        from character_card.library import DEFAULT_LIBRARY_PATH
 
-def format_message_history(parts: list[list[ModelRequestPart | ModelResponsePart]]) -> str:
-    out = []
+        global card_lorebooks
+        cog = CharacterCardCog(discord_bot, msg_nodes, http_clients.get("cdn"), config.get("character_card_library", DEFAULT_LIBRARY_PATH))
+        await discord_bot.add_cog(cog)
+        card_lorebooks = cog.lorebook
+        loaded.append("character card")
 
-    for part in parts:
-        for msg in part:
-            if isinstance(msg, TextPart) and len(msg.content) > 0:
-                out.append(msg.content)
-            elif isinstance(msg, ToolCallPart):
-                out.append(f"-# Using tool `{msg.tool_name}`")
-            # We don't show thinking...
+    if loaded:
+        logging.info(f"Loaded {', '.join(loaded)} in {time.perf_counter() - started_at:.2f}s")
 
-    return "\n\n".join(out)
 
 async def main() -> None:
-    if "voice" in config and config["voice"]["enabled"]:
-        discord_bot.tree.add_command(gemini_live.live_command)
-    if config.get("enable_character_card", False):
-        from character_card.cog import CharacterCardCog
+    global attachment_store
+    config = current_config()
+    attachment_store = AttachmentStore.from_config(http_clients.get("cdn"), config.get("attachment_cache"))
+    if not PREPROCESSING_AVAILABLE and (preprocessed := [model for model, parameters in config["models"].items() if (parameters or {}).get("image_preprocess")]):
+        logging.warning(f"Pillow is not installed, images are sent as is to {', '.join(preprocessed)} (image_preprocess needs Pillow)")
+    asyncio.create_task(watch_config())
+    asyncio.create_task(mcp_pool.start())
+
+    await shared_state.start()
+
+    if (node_store := NodeStore.from_config(config.get("message_store"))) is not None:
+        try:
+            await node_store.start()
+        except Exception:
+            logging.exception(f"Error opening message store {node_store.path}, keeping messages in memory only")
+            node_store = None
+        else:
+            msg_nodes.store = node_store
 
-        await discord_bot.add_cog(CharacterCardCog(discord_bot, msg_nodes))
+    if metrics_options := config.get("metrics"):
+        # Workers can't share a port, each one serves on the base port plus its first shard id unless LLMCORD_METRICS_PORT is set
+        if os.environ.get("LLMCORD_METRICS_PORT"):
+            metrics_port = int(os.environ["LLMCORD_METRICS_PORT"])
+        else:
+            metrics_port = metrics_options.get("port", 9100) + min(getattr(discord_bot, "shard_ids", None) or [0])
+        await metrics.serve(metrics_options.get("host", "127.0.0.1"), metrics_port)
+
+    await load_plugins(config)
 
-    await discord_bot.start(config["bot_token"])
+    try:
+        await discord_bot.start(config["bot_token"])
+    finally:
+        if node_store is not None:
+            await node_store.close()
+        await http_clients.aclose()
+        await shared_state.close()
 
 
 if __name__ == "__main__":
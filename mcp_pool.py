@@ -0,0 +1,252 @@
+import asyncio
+import collections
+import dataclasses
+import json
+import logging
+import time
+from dataclasses import field
+from typing import Any, Optional
+
+from pydantic_ai import ModelRetry, RunContext
+from pydantic_ai.mcp import MCPServer, MCPServerStdio, MCPServerStreamableHTTP
+from pydantic_ai.toolsets import WrapperToolset
+from pydantic_ai.toolsets.abstract import ToolsetTool
+
+from metrics import TOOL_CACHE, TOOL_CALL_SECONDS
+
+DEFAULT_MAX_CONCURRENCY = 4
+HEALTH_CHECK_INTERVAL_SECONDS = 30
+HEALTH_CHECK_TIMEOUT_SECONDS = 10
+START_TIMEOUT_SECONDS = 30
+RESTART_DELAY_SECONDS = 5
+DEFAULT_CACHE_TTL_SECONDS = 60
+MAX_CACHED_RESULTS = 256
+
+# Options handled by the pool rather than passed to the MCP server
+POOL_OPTIONS = ("max_concurrency", "timeout", "cache")
+
+
+@dataclasses.dataclass
+class PooledMCPServer(WrapperToolset):
+    """
+    MCP server that stays connected across agent runs.
+    The connection is owned by a single background task, so sessions and stdio subprocesses
+    are started once and shared by every conversation instead of per message.
+
+    Results of tools listed in `cache` are reused for their `ttl`, and identical calls in progress are shared.
+    Other tools may have side effects and always run
+    """
+    server_name: str = ""
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    # Seconds, per call
+    timeout: Optional[float] = None
+    # Tool name (without the server prefix) -> options: ttl, timeout
+    cache: dict[str, dict] = field(default_factory=dict)
+
+    _task: Optional[asyncio.Task] = field(default=None, init=False, repr=False)
+    _ready: asyncio.Event = field(default_factory=asyncio.Event, init=False, repr=False)
+    _restart: asyncio.Event = field(default_factory=asyncio.Event, init=False, repr=False)
+    _semaphore: asyncio.Semaphore = field(init=False, repr=False)
+    # (tool name, arguments) -> (expires at, result)
+    _results: collections.OrderedDict[tuple[str, str], tuple[float, Any]] = field(default_factory=collections.OrderedDict, init=False, repr=False)
+    _in_flight: dict[tuple[str, str], asyncio.Task] = field(default_factory=dict, init=False, repr=False)
+    # Bumped by every uncached call, results of cached calls that overlapped one are not kept
+    _generation: int = field(default=0, init=False, repr=False)
+    # Set when the last connection attempt failed, until one succeeds
+    _failed: bool = field(default=False, init=False, repr=False)
+    _calls: set[asyncio.Task] = field(default_factory=set, init=False, repr=False)
+
+    def __post_init__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    @property
+    def server(self) -> MCPServer:
+        return self.wrapped
+
+    async def _run(self):
+        while True:
+            try:
+                async with self.server:
+                    logging.info(f"MCP server {self.server_name} connected")
+                    self._failed = False
+                    self._ready.set()
+                    try:
+                        await self._restart.wait()
+                    finally:
+                        # The session is only closed once nothing uses it, a hung call would keep it open
+                        await self._cancel_calls()
+                logging.info(f"MCP server {self.server_name} restarting")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception(f"MCP server {self.server_name} failed")
+                self._failed = True
+                await asyncio.sleep(RESTART_DELAY_SECONDS)
+            finally:
+                self._ready.clear()
+                self._restart.clear()
+
+    def _ensure_task(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def start(self):
+        self._ensure_task()
+        await asyncio.wait_for(self._ready.wait(), START_TIMEOUT_SECONDS)
+
+    async def _cancel_calls(self):
+        for call in self._calls:
+            call.cancel()
+        await asyncio.gather(*self._calls, return_exceptions=True)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def check_health(self) -> bool:
+        if not self._ready.is_set():
+            return False
+
+        try:
+            await asyncio.wait_for(self.server.list_tools(), HEALTH_CHECK_TIMEOUT_SECONDS)
+            return True
+        except Exception:
+            logging.exception(f"MCP server {self.server_name} failed health check")
+            self._restart.set()
+            return False
+
+    # Runs enter/exit every toolset, the shared connection is managed by start/stop instead.
+    # Waiting for the server happens in get_tools, which can carry on without it
+    async def __aenter__(self):
+        self._ensure_task()
+        return self
+
+    async def __aexit__(self, *args: Any) -> Optional[bool]:
+        return None
+
+    async def get_tools(self, ctx: RunContext) -> dict[str, ToolsetTool]:
+        if self._failed:
+            # Don't make every run wait for a server that can't start, the restart loop keeps trying
+            return {}
+        try:
+            await self.start()
+        except asyncio.TimeoutError:
+            logging.warning(f"MCP server {self.server_name} is unavailable, continuing without its tools")
+            return {}
+
+        return await super().get_tools(ctx)
+
+    async def _call(self, name: str, tool_args: dict[str, Any], ctx: RunContext, tool: ToolsetTool, timeout: Optional[float]) -> Any:
+        async with self._semaphore:
+            await self.start()
+            with TOOL_CALL_SECONDS.time(server=self.server_name, tool=name):
+                # A task of its own so a restart can cancel it without cancelling the run
+                call = asyncio.ensure_future(super().call_tool(name, tool_args, ctx, tool))
+                self._calls.add(call)
+                call.add_done_callback(self._calls.discard)
+                try:
+                    return await asyncio.wait_for(call, timeout)
+                except asyncio.TimeoutError:
+                    logging.warning(f"MCP tool {name} timed out after {timeout}s")
+                    raise ModelRetry(f"The tool didn't respond within {timeout} seconds")
+                except asyncio.CancelledError:
+                    if call.cancelled() and not asyncio.current_task().cancelling():
+                        raise ModelRetry("The tool server restarted before the call finished")
+                    raise
+
+    def _invalidate(self):
+        self._generation += 1
+        self._results.clear()
+
+    async def _call_and_cache(self, key: tuple[str, str], ttl: float, *args) -> Any:
+        generation = self._generation
+        try:
+            result = await self._call(*args)
+            if generation != self._generation:
+                return result
+            self._results[key] = (time.monotonic() + ttl, result)
+            self._results.move_to_end(key)
+            while len(self._results) > MAX_CACHED_RESULTS:
+                self._results.popitem(last=False)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    async def call_tool(self, name: str, tool_args: dict[str, Any], ctx: RunContext, tool: ToolsetTool) -> Any:
+        tool_name = name.removeprefix(f"{self.server.tool_prefix}_") if self.server.tool_prefix else name
+        if (options := self.cache.get(tool_name)) is None:
+            # Any other tool may change what the cached ones return, e.g. create_entities and read_graph
+            self._invalidate()
+            try:
+                return await self._call(name, tool_args, ctx, tool, self.timeout)
+            finally:
+                self._invalidate()
+
+        timeout = options.get("timeout", self.timeout)
+        key = (name, json.dumps(tool_args, sort_keys=True, separators=(",", ":"), default=str))
+        if (cached := self._results.get(key)) is not None and cached[0] > time.monotonic():
+            TOOL_CACHE.inc(server=self.server_name, tool=name, result="hit")
+            return cached[1]
+
+        if (task := self._in_flight.get(key)) is not None:
+            TOOL_CACHE.inc(server=self.server_name, tool=name, result="shared")
+        else:
+            TOOL_CACHE.inc(server=self.server_name, tool=name, result="miss")
+            task = self._in_flight[key] = asyncio.create_task(
+                self._call_and_cache(key, options.get("ttl", DEFAULT_CACHE_TTL_SECONDS), name, tool_args, ctx, tool, timeout)
+            )
+        # A caller that gives up doesn't cancel the call for the others
+        return await asyncio.shield(task)
+
+
+class MCPPool:
+    def __init__(self, servers: list[PooledMCPServer]):
+        self.servers = servers
+        self._health_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, options: dict[str, dict]) -> "MCPPool":
+        return cls([parse_mcp_option(name, option) for name, option in options.items()])
+
+    async def start(self, health_check_interval: float = HEALTH_CHECK_INTERVAL_SECONDS):
+        results = await asyncio.gather(*[server.start() for server in self.servers], return_exceptions=True)
+        for server, result in zip(self.servers, results):
+            if isinstance(result, BaseException):
+                logging.error(f"MCP server {server.server_name} failed to start, retrying on first use", exc_info=result)
+
+        if self._health_task is None and self.servers:
+            self._health_task = asyncio.create_task(self._health_check_loop(health_check_interval))
+
+    async def stop(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        await asyncio.gather(*[server.stop() for server in self.servers])
+
+    async def _health_check_loop(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await asyncio.gather(*[server.check_health() for server in self.servers])
+
+
+def parse_mcp_option(name: str, option: dict) -> PooledMCPServer:
+    server_option = {key: value for key, value in option.items() if key not in POOL_OPTIONS}
+    if "url" in server_option:
+        server = MCPServerStreamableHTTP(server_option["url"], tool_prefix=name, max_retries=server_option.get("max_retries", 5))
+    else:
+        server = MCPServerStdio(**{"tool_prefix": name, **server_option})
+
+    # Only listed tools are cached, a list of names uses the default TTL
+    cache = option.get("cache") or {}
+    if isinstance(cache, list):
+        cache = dict.fromkeys(cache)
+
+    return PooledMCPServer(
+        server,
+        server_name=name,
+        max_concurrency=option.get("max_concurrency", DEFAULT_MAX_CONCURRENCY),
+        timeout=option.get("timeout"),
+        cache={tool: tool_options or {} for tool, tool_options in cache.items()},
+    )
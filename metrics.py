@@ -0,0 +1,160 @@
+import asyncio
+import bisect
+import contextlib
+import logging
+import math
+import time
+from typing import Callable, Iterator
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(labels)} {_format_value(value)}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # Labels -> (per bucket counts with +Inf last, sum)
+        self.values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        counts, total = self.values.setdefault(_labels(labels), ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(labels, (('le', _format_value(bound)),))} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {_format_value(total[0])}"
+            yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+
+
+class Gauge:
+    """Read when scraped. `read` returns a value, or a list of (labels, value) pairs"""
+
+    def __init__(self, name: str, help: str, read: Callable[[], float | list[tuple[dict, float]]]):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self) -> Iterator[str]:
+        try:
+            values = self.read()
+        except Exception:
+            logging.exception(f"Error reading gauge {self.name}")
+            return
+
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in values if isinstance(values, list) else [({}, values)]:
+            if value is not None:
+                yield f"{self.name}{_format_labels(_labels(labels))} {_format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Counter | Histogram | Gauge] = []
+
+    def counter(self, name: str, help: str) -> Counter:
+        self.metrics.append(metric := Counter(name, help))
+        return metric
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        self.metrics.append(metric := Histogram(name, help, buckets))
+        return metric
+
+    def gauge(self, name: str, help: str, read: Callable[[], float | list[tuple[dict, float]]]) -> Gauge:
+        self.metrics.append(metric := Gauge(name, help, read))
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram("llmcord_stage_seconds", "Time spent in each stage of handling a message")
+CHAIN_NODES = registry.counter("llmcord_chain_nodes_total", "Reply chain nodes by where they were found (cache, store or discord)")
+DISCORD_FETCHES = registry.counter("llmcord_discord_fetches_total", "Discord API requests made while resolving reply chains")
+ATTACHMENT_DOWNLOAD_SECONDS = registry.histogram("llmcord_attachment_download_seconds", "Attachment download time")
+TIME_TO_FIRST_TOKEN_SECONDS = registry.histogram("llmcord_time_to_first_token_seconds", "Time from starting a run to the first streamed event")
+TOKENS_PER_SECOND = registry.histogram("llmcord_tokens_per_second", "Output tokens per second after the first token", TOKENS_PER_SECOND_BUCKETS)
+TOOL_CALL_SECONDS = registry.histogram("llmcord_tool_call_seconds", "MCP tool call time")
+TOOL_CACHE = registry.counter("llmcord_tool_cache_total", "Cacheable MCP tool calls by result (hit, miss or shared with an identical call in progress)")
+DISCORD_EDIT_SECONDS = registry.histogram("llmcord_discord_edit_seconds", "Discord message edit time")
+DISCORD_EDITS = registry.counter("llmcord_discord_edits_total", "Scheduled Discord message edits by result (sent, superseded or failed)")
+
+
+async def serve(host: str, port: int, registry: Registry = registry) -> asyncio.AbstractServer:
+    """Serve the registry in the Prometheus text format on any path"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # Only the request line and headers are read, there's nothing else to route on
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    logging.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,134 @@
+import collections
+import sys
+from typing import Any, Callable, Hashable, Iterator, Optional
+
+from pydantic_ai.messages import BinaryContent, ModelMessage
+
+from node_store import NodeStore
+
+# Rough fixed cost of a node and its message objects
+NODE_OVERHEAD_BYTES = 1024
+
+
+def estimate_messages_size(messages: Optional[list[ModelMessage]]) -> int:
+    size = NODE_OVERHEAD_BYTES
+    for message in messages or ():
+        for part in message.parts:
+            content = getattr(part, "content", None)
+            for item in content if isinstance(content, list) else (content,):
+                if isinstance(item, str):
+                    size += sys.getsizeof(item)
+                elif isinstance(item, BinaryContent):
+                    size += len(item.data)
+    return size
+
+
+class MsgNodeCache:
+    """
+    Access-ordered LRU cache of MsgNodes bounded by node count and estimated memory.
+    Nodes whose lock is held are in use by a request and are never evicted.
+    When a store is attached, committed nodes are also written to it
+    """
+
+    def __init__(self, max_nodes: int, max_bytes: int, sizeof: Callable[[Any], int] = lambda node: estimate_messages_size(node.msg)):
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.store: Optional[NodeStore] = None
+
+        self._nodes: collections.OrderedDict[Hashable, Any] = collections.OrderedDict()
+        self._sizes: dict[Hashable, int] = {}
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._nodes)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self._nodes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._nodes
+
+    def __getitem__(self, key: Hashable) -> Any:
+        node = self._nodes[key]
+        self._nodes.move_to_end(key)
+        return node
+
+    def __setitem__(self, key: Hashable, node: Any) -> None:
+        self._nodes[key] = node
+        self._nodes.move_to_end(key)
+        self.commit(key)
+
+    def __delitem__(self, key: Hashable) -> None:
+        del self._nodes[key]
+        self.total_bytes -= self._sizes.pop(key, 0)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Look up a node for a chain walk, the only lookup counted as a hit or miss"""
+        try:
+            node = self[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return node
+
+    def setdefault(self, key: Hashable, default: Any) -> Any:
+        if (node := self._nodes.get(key)) is not None:
+            self._nodes.move_to_end(key)
+            return node
+        self[key] = default
+        return default
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._nodes:
+            return default
+        node = self._nodes[key]
+        del self[key]
+        return node
+
+    def commit(self, key: Hashable) -> None:
+        """Record that a node's messages changed: recompute its size and persist it"""
+        node = self._nodes[key]
+        size = self.sizeof(node)
+        self.total_bytes += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+
+        if self.store is not None and node.msg is not None:
+            self.store.put(key, node)
+
+    def evict(self) -> int:
+        """Evict least recently used nodes until within bounds, skipping locked nodes"""
+        excess_nodes = len(self._nodes) - self.max_nodes
+        excess_bytes = self.total_bytes - self.max_bytes
+        if excess_nodes <= 0 and excess_bytes <= 0:
+            return 0
+
+        victims = []
+        for key, node in self._nodes.items():
+            if excess_nodes <= 0 and excess_bytes <= 0:
+                break
+            if node.lock.locked():
+                continue
+            victims.append(key)
+            excess_nodes -= 1
+            excess_bytes -= self._sizes.get(key, 0)
+
+        for key in victims:
+            del self[key]
+
+        self.evictions += len(victims)
+        return len(victims)
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "nodes": len(self._nodes),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,43 @@
+import asyncio
+import dataclasses
+from dataclasses import field
+from typing import Any, Optional
+
+import discord
+from pydantic_ai.messages import ModelMessage
+
+from token_budget import estimate_messages_tokens, estimate_text_tokens
+
+
+@dataclasses.dataclass
+class MsgNode:
+    msg: Optional[list[ModelMessage]] = None
+
+    fetch_parent_failed: bool = False
+    parent_msg: Optional[discord.Message] = None
+    parent_msg_id: Optional[int] = None
+    parent_channel_id: Optional[int] = None
+    override_system_prompt: bool = False
+    # Summary of this node and everything before it, used instead of them by later replies
+    summary: Optional[str] = None
+    tokens: Optional[int] = None
+    # Set on a character card's first message, see character_card.lorebook
+    lorebook: Optional[Any] = None
+    # The card (SHA-256 of its PNG) and user the lorebook was rendered for, stored so it can be rebuilt
+    card_digest: Optional[str] = None
+    card_user: Optional[str] = None
+    # Lorebook keys found in this node, scanned once
+    lore_hits: Optional[frozenset] = None
+
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def set_parent(self, parent_msg: discord.Message):
+        self.parent_msg = parent_msg
+        self.parent_msg_id = parent_msg.id
+        self.parent_channel_id = parent_msg.channel.id
+
+    def token_count(self) -> int:
+        """Estimated tokens the node adds to a chain, computed once per node"""
+        if self.tokens is None:
+            self.tokens = estimate_text_tokens(self.summary) if self.summary is not None else estimate_messages_tokens(self.msg)
+        return self.tokens
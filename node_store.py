@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+from pydantic_ai.messages import ModelMessagesTypeAdapter
+
+FLUSH_INTERVAL_SECONDS = 1
+COMPACT_INTERVAL_SECONDS = 60 * 60
+DEFAULT_TTL_DAYS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS msg_nodes (
+    id INTEGER PRIMARY KEY,
+    messages BLOB NOT NULL,
+    parent_channel_id INTEGER,
+    parent_msg_id INTEGER,
+    override_system_prompt INTEGER NOT NULL,
+    fetch_parent_failed INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    summary TEXT,
+    card_digest TEXT,
+    card_user TEXT
+);
+CREATE INDEX IF NOT EXISTS msg_nodes_updated_at ON msg_nodes (updated_at);
+"""
+
+
+class NodeStore:
+    """
+    SQLite (WAL mode) backed store for MsgNode data so reply chains survive restarts.
+    Writes are queued and flushed in batches from a background task
+    """
+
+    def __init__(self, path: str, ttl_days: float = DEFAULT_TTL_DAYS):
+        self.path = path
+        self.ttl_seconds = ttl_days * 24 * 60 * 60
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.Lock()
+        self._pending: dict[int, tuple] = {}
+        self._writing: dict[int, tuple] = {}
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+
+    @classmethod
+    def from_config(cls, options: Optional[dict]) -> Optional["NodeStore"]:
+        if not options:
+            return None
+        return cls(options.get("path", "msg_nodes.sqlite3"), ttl_days=options.get("ttl_days", DEFAULT_TTL_DAYS))
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(msg_nodes)")}
+        # Stores created before summaries and character card references were added
+        for column in ("summary", "card_digest", "card_user"):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE msg_nodes ADD COLUMN {column} TEXT")
+        self._conn = conn
+
+    async def start(self):
+        await asyncio.to_thread(self._open)
+        await asyncio.to_thread(self._compact)
+        self._tasks = [asyncio.create_task(self._write_loop()), asyncio.create_task(self._compact_loop())]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+        with self._conn_lock:
+            self._conn.close()
+
+    def put(self, msg_id: int, node: Any):
+        """Queue a node for writing. Only references are captured here, serialization happens off the event loop"""
+        self._pending[msg_id] = (
+            msg_id,
+            node.msg,
+            node.parent_channel_id,
+            node.parent_msg_id,
+            node.override_system_prompt,
+            node.fetch_parent_failed,
+            node.summary,
+            node.card_digest,
+            node.card_user,
+        )
+        self._wakeup.set()
+
+    async def get(self, msg_id: int) -> Optional[dict[str, Any]]:
+        """Load a node's fields, or None if it is not stored"""
+        if (pending := self._pending.get(msg_id) or self._writing.get(msg_id)) is not None:
+            _, messages, parent_channel_id, parent_msg_id, override_system_prompt, fetch_parent_failed, summary, card_digest, card_user = pending
+        else:
+            row = await asyncio.to_thread(self._read, msg_id)
+            if row is None:
+                return None
+            messages, parent_channel_id, parent_msg_id, override_system_prompt, fetch_parent_failed, summary, card_digest, card_user = row
+            messages = ModelMessagesTypeAdapter.validate_json(messages)
+
+        return dict(
+            msg=messages,
+            parent_channel_id=parent_channel_id,
+            parent_msg_id=parent_msg_id,
+            override_system_prompt=bool(override_system_prompt),
+            fetch_parent_failed=bool(fetch_parent_failed),
+            summary=summary,
+            card_digest=card_digest,
+            card_user=card_user,
+        )
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._writing, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, list(self._writing.values()))
+        finally:
+            self._writing = {}
+
+    def _read(self, msg_id: int) -> Optional[tuple]:
+        with self._conn_lock:
+            return self._conn.execute(
+                "SELECT messages, parent_channel_id, parent_msg_id, override_system_prompt, fetch_parent_failed, summary, card_digest, card_user FROM msg_nodes WHERE id = ?",
+                (msg_id,),
+            ).fetchone()
+
+    def _write(self, batch: list[tuple]):
+        now = time.time()
+        rows = [
+            (msg_id, ModelMessagesTypeAdapter.dump_json(messages), parent_channel_id, parent_msg_id, override_system_prompt, fetch_parent_failed, now, summary, card_digest, card_user)
+            for msg_id, messages, parent_channel_id, parent_msg_id, override_system_prompt, fetch_parent_failed, summary, card_digest, card_user in batch
+        ]
+        with self._conn_lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO msg_nodes (id, messages, parent_channel_id, parent_msg_id, override_system_prompt, fetch_parent_failed, updated_at, summary, card_digest, card_user) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def _compact(self):
+        with self._conn_lock, self._conn:
+            deleted = self._conn.execute("DELETE FROM msg_nodes WHERE updated_at < ?", (time.time() - self.ttl_seconds,)).rowcount
+        if deleted:
+            logging.info(f"Removed {deleted} expired message nodes from the store")
+
+    async def _write_loop(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Error writing message nodes to the store")
+
+    async def _compact_loop(self):
+        while True:
+            await asyncio.sleep(COMPACT_INTERVAL_SECONDS)
+            try:
+                await asyncio.to_thread(self._compact)
+            except Exception:
+                logging.exception("Error compacting the message node store")
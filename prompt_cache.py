@@ -0,0 +1,64 @@
+from datetime import datetime
+
+import discord
+from pydantic_ai.messages import ModelMessage
+from pydantic_ai.models.openai import OpenAIModel
+
+CACHE_CONTROL = {"type": "ephemeral"}
+# With breakpoints on the last two user messages, each turn reads the prefix the previous turn wrote
+CACHED_USER_MESSAGES = 2
+# Starts the volatile context, which is left out of stored history and so goes after the last breakpoint
+VOLATILE_CONTEXT_PREFIX = "[Sent "
+
+# Volatile system prompt tags, replaced with a pointer to the context added to the latest message
+STATIC_TAG_REPLACEMENTS = {
+    "{date}": "given at the end of the latest message",
+    "{time}": "given at the end of the latest message",
+    "{user_id}": "the user mentioned at the end of the latest message",
+}
+
+
+def static_system_prompt(template: str) -> str:
+    for tag, replacement in STATIC_TAG_REPLACEMENTS.items():
+        template = template.replace(tag, replacement)
+    return template
+
+
+def volatile_context(author: discord.User | discord.Member) -> str:
+    """Date, time and user for the latest message, kept out of the system prompt so its prefix can be cached. Goes last in the message"""
+    now = datetime.now().astimezone()
+    return f"{VOLATILE_CONTEXT_PREFIX}{now.strftime('%B %d %Y %H:%M:%S %Z%z')} by {author.mention}]"
+
+
+def is_volatile(part: dict) -> bool:
+    return part.get("type") == "text" and part.get("text", "").startswith(VOLATILE_CONTEXT_PREFIX)
+
+
+def add_cache_control(message: dict):
+    """Mark the last part of a message, before the volatile context so the cached prefix matches the stored history"""
+    content = message.get("content")
+    if isinstance(content, str):
+        message["content"] = [{"type": "text", "text": content, "cache_control": CACHE_CONTROL}]
+    elif content:
+        index = len(content) - 1
+        while index >= 0 and is_volatile(content[index]):
+            index -= 1
+        if index >= 0:
+            message["content"] = [*content[:index], {**content[index], "cache_control": CACHE_CONTROL}, *content[index + 1:]]
+
+
+class CacheControlOpenAIModel(OpenAIModel):
+    """
+    Adds Anthropic-style cache_control breakpoints to the system prompt and the latest user messages,
+    for APIs that need them to cache prompts (Anthropic models on OpenRouter and Anthropic-compatible APIs)
+    """
+
+    async def _map_messages(self, messages: list[ModelMessage]):
+        openai_messages = await super()._map_messages(messages)
+
+        system_messages = [message for message in openai_messages[:1] if message["role"] == "system"]
+        user_messages = [message for message in openai_messages if message["role"] == "user"][-CACHED_USER_MESSAGES:]
+        for message in system_messages + user_messages:
+            add_cache_control(message)
+
+        return openai_messages
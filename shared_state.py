@@ -0,0 +1,104 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+POLL_INTERVAL_SECONDS = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shared_state (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class LocalState:
+    """Bot-wide settings such as the current model, kept in this process"""
+
+    def __init__(self):
+        self.values: dict[str, Any] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.values.get(key, default)
+
+    async def set(self, key: str, value: Any):
+        self.values[key] = value
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SQLiteState(LocalState):
+    """
+    Settings shared by worker processes through a SQLite database.
+    Reads are served from memory, changes made by other workers are picked up by polling
+    """
+
+    def __init__(self, path: str, poll_interval: float = POLL_INTERVAL_SECONDS):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._local_writes = 0
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        self._conn = conn
+
+    def _read(self) -> dict[str, Any]:
+        with self._conn_lock:
+            rows = self._conn.execute("SELECT key, value FROM shared_state").fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def _write(self, key: str, value: Any):
+        with self._conn_lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO shared_state VALUES (?, ?, ?)", (key, json.dumps(value), time.time()))
+
+    async def start(self):
+        await asyncio.to_thread(self._open)
+        self.values = await asyncio.to_thread(self._read)
+        self._task = asyncio.create_task(self._poll_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        with self._conn_lock:
+            self._conn.close()
+
+    async def set(self, key: str, value: Any):
+        await asyncio.to_thread(self._write, key, value)
+        self.values[key] = value
+        self._local_writes += 1
+
+    async def _poll_loop(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            local_writes = self._local_writes
+            try:
+                values = await asyncio.to_thread(self._read)
+                # A read that started before a local write may not include it
+                if local_writes == self._local_writes:
+                    self.values = values
+            except Exception:
+                logging.exception("Error reading shared state")
+
+
+def create_shared_state(options: Optional[dict]) -> LocalState:
+    """SQLite backed when `sharding.state_path` is set, in-process otherwise"""
+    if options and (path := options.get("state_path")):
+        return SQLiteState(path)
+    return LocalState()
@@ -0,0 +1,74 @@
+from typing import Optional
+
+from pydantic_ai.messages import PartDeltaEvent, PartStartEvent, ModelResponsePart, TextPart, TextPartDelta, ToolCallPart, \
+    ToolCallPartDelta
+
+PART_SEPARATOR = "\n\n"
+
+
+class StreamRenderer:
+    """
+    Renders a streamed model response into pages of at most `max_length` characters, one per Discord message.
+    Text deltas are appended to the last page only, so streaming a long response costs time linear in its length
+    """
+
+    def __init__(self, max_length: int):
+        self.max_length = max_length
+        self.pages: list[str] = []
+        # Pages changed since the last take_dirty()
+        self.dirty: set[int] = set()
+
+        self._part: Optional[ModelResponsePart] = None
+        self._part_rendered = False
+
+    def append(self, text: str):
+        while text:
+            if not self.pages or len(self.pages[-1]) >= self.max_length:
+                self.pages.append("")
+
+            room = self.max_length - len(self.pages[-1])
+            self.pages[-1] += text[:room]
+            self.dirty.add(len(self.pages) - 1)
+            text = text[room:]
+
+    def replace(self, text: str):
+        self.pages = []
+        self._part = None
+        self.append(text)
+        self.dirty = set(range(len(self.pages)))
+
+    def take_dirty(self) -> set[int]:
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def mark_all_dirty(self):
+        self.dirty = set(range(len(self.pages)))
+
+    def _append_part_text(self, text: str):
+        if not text:
+            return
+        if not self._part_rendered and self.pages:
+            self.append(PART_SEPARATOR)
+        self._part_rendered = True
+        self.append(text)
+
+    def on_event(self, event: PartStartEvent | PartDeltaEvent):
+        if isinstance(event, PartStartEvent):
+            self.end_part()
+            self._part = event.part
+            self._part_rendered = False
+            if isinstance(event.part, TextPart):
+                self._append_part_text(event.part.content)
+        elif isinstance(event, PartDeltaEvent):
+            if isinstance(event.delta, TextPartDelta):
+                # Not applied to the part, that would copy the whole text on every delta
+                self._append_part_text(event.delta.content_delta)
+            elif isinstance(event.delta, ToolCallPartDelta) and isinstance(self._part, ToolCallPart):
+                self._part = event.delta.apply(self._part)
+
+    def end_part(self):
+        """Render parts that are only shown once complete"""
+        if isinstance(self._part, ToolCallPart):
+            self._append_part_text(f"-# Using tool `{self._part.tool_name}`")
+        # We don't show thinking...
+        self._part = None
@@ -0,0 +1,28 @@
+from typing import Optional
+
+from pydantic_ai.messages import ModelMessage, ModelRequest, ModelResponse, TextPart, UserPromptPart
+
+DEFAULT_SUMMARY_THRESHOLD = 20
+DEFAULT_SUMMARY_KEEP_RECENT = 10
+
+SUMMARY_INSTRUCTIONS = """\
+Summarize the conversation below so it can replace it as context for continuing the conversation.
+Keep names, facts, decisions, open questions and anything the assistant committed to. Be concise, no preamble."""
+
+
+def render_transcript(previous_summary: Optional[str], messages: list[ModelMessage]) -> str:
+    """Plain text transcript of messages (oldest first) for the summarizer, tool calls and attachments are left out"""
+    lines = [f"Summary of the conversation so far:\n{previous_summary}\n"] if previous_summary else []
+    for message in messages:
+        for part in message.parts:
+            if isinstance(message, ModelRequest) and isinstance(part, UserPromptPart):
+                content = part.content
+                text = content if isinstance(content, str) else " ".join(item if isinstance(item, str) else "[attachment]" for item in content)
+                lines.append(f"User: {text}")
+            elif isinstance(message, ModelResponse) and isinstance(part, TextPart):
+                lines.append(f"Assistant: {part.content}")
+    return "\n".join(lines)
+
+
+def summary_message(summary: str) -> ModelRequest:
+    return ModelRequest(parts=[UserPromptPart(content=f"Summary of the earlier conversation:\n{summary}")])
@@ -0,0 +1,66 @@
+import http.server
+import threading
+import unittest
+
+from http_clients import HTTPClients
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+
+    def do_GET(self):
+        self.do_HEAD()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPClientsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.connections = 0
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    async def test_requests_reuse_the_pooled_connection(self):
+        clients = HTTPClients()
+        try:
+            await clients.prewarm({"provider": self.base_url})
+            for _ in range(5):
+                response = await clients.get("provider").get(self.base_url)
+                self.assertEqual(response.text, "ok")
+
+            self.assertIs(clients.get("provider"), clients.get("provider"))
+            self.assertEqual(self.server.connections, 1)
+            self.assertEqual(clients.connections(), [({"pool": "provider"}, 1)])
+        finally:
+            await clients.aclose()
+
+    async def test_pools_are_separate(self):
+        clients = HTTPClients({"pools": {"cdn": {"max_connections": 1}}})
+        try:
+            await clients.get("cdn").get(self.base_url)
+            await clients.get("provider").get(self.base_url)
+
+            self.assertIsNot(clients.get("cdn"), clients.get("provider"))
+            self.assertEqual(self.server.connections, 2)
+        finally:
+            await clients.aclose()
+
+
+if __name__ == "__main__":
+    unittest.main()
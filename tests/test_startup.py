@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Time allowed for `import llmcord`, not counting interpreter startup
+IMPORT_BUDGET_SECONDS = 5.0
+# Imported only when needed: voice and character card support by load_plugins when enabled,
+# Pillow when an image is preprocessed and h2 by httpx once a client uses HTTP/2
+LAZY_MODULES = ("google.genai", "discord.ext.voice_recv", "PIL", "h2")
+
+CONFIG = """\
+bot_token: token
+client_id: 1
+providers:
+  openai:
+    base_url: http://127.0.0.1:9/v1
+models:
+  openai/gpt-4.1:
+permissions:
+  users: {admin_ids: [], allowed_ids: [], blocked_ids: []}
+  roles: {allowed_ids: [], blocked_ids: []}
+  channels: {allowed_ids: [], blocked_ids: []}
+system_prompt: ""
+voice:
+  enabled: false
+enable_character_card: false
+"""
+
+SCRIPT = textwrap.dedent("""\
+    import json, sys, time
+    started_at = time.perf_counter()
+    import llmcord
+    print(json.dumps({"seconds": time.perf_counter() - started_at, "modules": sorted(sys.modules)}))
+""")
+
+
+class StartupTest(unittest.TestCase):
+    def test_import_skips_disabled_subsystems(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "config.yaml"), "w") as f:
+                f.write(CONFIG)
+            env = {**os.environ, "PYTHONPATH": REPO_DIR}
+            env.pop("LLMCORD_SHARD_IDS", None)
+            process = subprocess.run([sys.executable, "-c", SCRIPT], cwd=directory, env=env, capture_output=True, text=True, timeout=60)
+
+        self.assertEqual(process.returncode, 0, process.stderr)
+        result = json.loads(process.stdout.splitlines()[-1])
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, result["modules"])
+        self.assertLess(result["seconds"], IMPORT_BUDGET_SECONDS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import functools
+import logging
+from typing import Optional
+
+from pydantic_ai.messages import AudioUrl, BinaryContent, ImageUrl, ModelMessage, TextPart, ThinkingPart, ToolCallPart, \
+    ToolReturnPart, UserPromptPart
+
+# Used when tiktoken isn't installed, close enough for English text
+CHARS_PER_TOKEN = 4
+# OpenAI's cost of a high detail 1024x1024 image, other providers are in the same range
+IMAGE_TOKENS = 765
+AUDIO_TOKENS = 1000
+# Role and separators around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@functools.cache
+def _encoding():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # Not installed, or the encoding couldn't be downloaded
+        logging.info("tiktoken unavailable, estimating tokens from character counts")
+        return None
+
+
+def estimate_text_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if (encoding := _encoding()) is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def estimate_content_tokens(item) -> int:
+    if isinstance(item, str):
+        return estimate_text_tokens(item)
+    elif isinstance(item, ImageUrl) or isinstance(item, BinaryContent) and item.is_image:
+        return IMAGE_TOKENS
+    elif isinstance(item, AudioUrl) or isinstance(item, BinaryContent) and item.is_audio:
+        return AUDIO_TOKENS
+    return 0
+
+
+def estimate_messages_tokens(messages: Optional[list[ModelMessage]]) -> int:
+    tokens = 0
+    for message in messages or ():
+        tokens += MESSAGE_OVERHEAD_TOKENS
+        for part in message.parts:
+            if isinstance(part, UserPromptPart):
+                content = part.content
+                tokens += sum(estimate_content_tokens(item) for item in ([content] if isinstance(content, str) else content))
+            elif isinstance(part, (TextPart, ThinkingPart)):
+                tokens += estimate_text_tokens(part.content)
+            elif isinstance(part, ToolCallPart):
+                tokens += estimate_text_tokens(part.tool_name) + estimate_text_tokens(part.args_as_json_str())
+            elif isinstance(part, ToolReturnPart):
+                tokens += estimate_text_tokens(part.model_response_str())
+            elif isinstance(content := getattr(part, "content", None), str):
+                tokens += estimate_text_tokens(content)
+    return tokens